@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import os
+import sys
+import time
+import pandas as pd
+
+"""
+Compare universal_id.extract_junction_chain_from_gtf with the original
+row-by-row implementation on the test/ GTFs (or any GTFs given).
+
+python benchmarks/bench_junction_chain.py --repeat 3
+"""
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, "scripts"))
+
+from universal_id import extract_junction_chain_from_gtf
+
+def extract_junction_chain_reference(gtf_file):
+    """
+    Original implementation (apply + groupby + iterrows), kept as the
+    reference the vectorized version must match.
+    """
+    chains = {}
+    gtf_file = gtf_file.copy()
+    gtf_file.columns = ["chr", "source", "feature", "start", "end",
+                         "score", "strand", "frame", "attribute"]
+    exons = gtf_file[gtf_file["feature"] == "exon"].copy()
+
+    def get_transcript_id(attr):
+        for field in attr.split(";"):
+            if 'transcript_id' in field:
+                return field.split('"')[1]
+        return None
+
+    exons["transcript_id"] = exons["attribute"].apply(get_transcript_id)
+
+    for tid, df in exons.groupby("transcript_id"):
+        df_sorted = df.sort_values("start")
+        chain = [df_sorted.iloc[0]["chr"]]
+        for _, row in df_sorted.iterrows():
+            chain.extend([row["start"], row["end"]])
+        chains[tid] = chain
+
+    return chains
+
+def best_time(func, gtf, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(gtf)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark junction chain extraction")
+    parser.add_argument("--gtf", nargs="+",
+                        default=sorted(glob.glob(os.path.join(REPO, "test", "*_corrected.gtf"))),
+                        help="GTF files to benchmark (default: test/*_corrected.gtf)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs per implementation; the best is reported")
+    args = parser.parse_args()
+
+    print("gtf\ttranscripts\treference_s\tvectorized_s\tspeedup")
+    for path in args.gtf:
+        gtf = pd.read_csv(path, sep="\t", header=None)
+        ref_time, ref_chains = best_time(extract_junction_chain_reference, gtf, args.repeat)
+        new_time, new_chains = best_time(extract_junction_chain_from_gtf, gtf, args.repeat)
+        if ref_chains != new_chains or list(ref_chains) != list(new_chains):
+            sys.exit(f"Chains differ from the reference implementation for {path}")
+        print(f"{os.path.basename(path)}\t{len(new_chains)}\t{ref_time:.3f}\t{new_time:.3f}\t{ref_time / new_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
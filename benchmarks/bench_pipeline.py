@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+"""
+Time and memory-profile every pipeline stage on synthetic cohorts of
+increasing size (synthetic_cohort.py), from the run_metrics.json report of
+sq_compare.py --collapseISM. Results are written to
+benchmarks/results/pipeline_<n>_samples.json and checked against the
+regression thresholds in benchmarks/results/thresholds.json.
+
+python benchmarks/bench_pipeline.py                       # 5, 50 and 200 samples
+python benchmarks/bench_pipeline.py --samples 5 --check   # fail on regressions
+python benchmarks/bench_pipeline.py --update_thresholds   # new baseline
+"""
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, "scripts"))
+
+from run_metrics import METRICS_FILE, STAGES
+from synthetic_cohort import generate_cohort
+
+RESULTS_DIR = os.path.join(REPO, "benchmarks", "results")
+THRESHOLDS_FILE = "thresholds.json"
+CHECKED = ["wall_s", "peak_rss_mb"]
+# Regressions smaller than this are timer/allocator noise, whatever the tolerance
+MIN_SLACK = {"wall_s": 0.5, "peak_rss_mb": 50}
+
+def machine():
+    return {
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__
+    }
+
+def run_pipeline(input_file, out, workers):
+    """Run sq_compare.py on a cohort and return its run metrics."""
+    if os.path.isdir(out):
+        shutil.rmtree(out)
+    command = [sys.executable, os.path.join(REPO, "sq_compare.py"), "--input_files", input_file,
+               "--out", out, "--collapseISM", "--workers", str(workers)]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(out, METRICS_FILE)) as f:
+        return json.load(f)
+
+def stage_results(metrics):
+    """Stage name -> time, memory and row counts, without the per-sample entries."""
+    return {
+        s["stage"]: {k: v for k, v in s.items() if k not in ("stage", "samples", "profile")}
+        for s in metrics["stages"]
+    }
+
+def thresholds_for(stages, tolerance):
+    """
+    Regression thresholds of one result: measured value plus tolerance (and
+    minimum slack). Values that were not measured (null) get no threshold.
+    """
+    return {
+        name: {key: round(max(values[key] * (1 + tolerance), values[key] + MIN_SLACK[key]), 3)
+               for key in CHECKED if values.get(key) is not None}
+        for name, values in stages.items()
+    }
+
+def check(result, thresholds):
+    """Stage metrics of a result above their threshold, as messages."""
+    limits = thresholds["samples"].get(str(result["samples"]))
+    if limits is None:
+        return []
+    regressions = []
+    for name, values in result["stages"].items():
+        for key in CHECKED:
+            limit = limits.get(name, {}).get(key)
+            if limit is not None and values.get(key) is not None and values[key] > limit:
+                regressions.append(f"{result['samples']} samples, {name}: {key} {values[key]} > {limit}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic cohorts")
+    parser.add_argument("--samples", type=int, nargs="+", default=[5, 50, 200],
+                        help="Cohort sizes to benchmark (default: 5 50 200)")
+    parser.add_argument("--isoforms", type=int, default=5000,
+                        help="Isoforms per sample")
+    parser.add_argument("--overlap", type=float, default=0.5,
+                        help="Fraction of the non-ISM isoforms shared by all samples")
+    parser.add_argument("--ism_rate", type=float, default=0.2,
+                        help="Fraction of isoforms that are ISM fragments")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="--workers of sq_compare.py")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "sq_compare_bench"),
+                        help="Folder for the generated cohorts (reused across runs) and pipeline outputs")
+    parser.add_argument("--results", default=RESULTS_DIR,
+                        help="Folder for the results and the regression thresholds")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with an error if a stage exceeds its regression threshold")
+    parser.add_argument("--update_thresholds", action="store_true",
+                        help="Set the regression thresholds of the benchmarked sizes from these results")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed relative increase over the baseline with --update_thresholds (default: 0.5)")
+    args = parser.parse_args()
+
+    cohort = {"isoforms": args.isoforms, "overlap": args.overlap, "ism_rate": args.ism_rate, "workers": args.workers}
+    thresholds_path = os.path.join(args.results, THRESHOLDS_FILE)
+    thresholds = {"cohort": cohort, "samples": {}}
+    if os.path.exists(thresholds_path):
+        with open(thresholds_path) as f:
+            thresholds = json.load(f)
+    comparable = thresholds["cohort"] == cohort
+    if args.update_thresholds and not comparable:
+        thresholds = {"cohort": cohort, "samples": {}}
+    if args.check and not comparable:
+        sys.exit(f"Thresholds in {thresholds_path} were set for {thresholds['cohort']}, not {cohort}")
+    os.makedirs(args.results, exist_ok=True)
+
+    print("samples\tstage\trows_in\trows_out\twall_s\tcpu_s\tpeak_rss_mb")
+    regressions = []
+    for n in args.samples:
+        input_file = generate_cohort(os.path.join(args.workdir, f"cohort_{n}"), n, args.isoforms,
+                                     args.overlap, args.ism_rate)
+        metrics = run_pipeline(input_file, os.path.join(args.workdir, f"run_{n}"), args.workers)
+        result = {"samples": n, "cohort": cohort, "machine": machine(), "started": metrics["started"],
+                  "total_wall_s": metrics["total_wall_s"], "stages": stage_results(metrics)}
+        with open(os.path.join(args.results, f"pipeline_{n}_samples.json"), "w") as f:
+            json.dump(result, f, indent=1)
+
+        for name in STAGES:
+            values = result["stages"].get(name)
+            if values:
+                print(f"{n}\t{name}\t{values.get('rows_in', '')}\t{values.get('rows_out', '')}\t"
+                      f"{values['wall_s']}\t{values['cpu_s']}\t{values['peak_rss_mb']}")
+        if args.update_thresholds:
+            thresholds["samples"][str(n)] = thresholds_for(result["stages"], args.tolerance)
+        elif comparable:
+            regressions += check(result, thresholds)
+
+    if args.update_thresholds:
+        thresholds.update(cohort=cohort, tolerance=args.tolerance, machine=machine())
+        with open(thresholds_path, "w") as f:
+            json.dump(thresholds, f, indent=1)
+        print(f"Regression thresholds saved to {thresholds_path}")
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    if args.check and regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import os
+import numpy as np
+import pandas as pd
+
+"""
+Generate a synthetic cohort of SQANTI3 outputs (classification, junctions,
+corrected GTF and abundance per sample) plus the sq_compare.py input file.
+
+Every sample draws its isoforms from one shared pool of junction chains:
+a core set present in all samples (--overlap of the non-ISM isoforms) and
+the rest picked at random from the remainder of the pool, so part of them
+is shared by chance. A fraction of each sample's isoforms (--ism_rate) are
+5'/3' fragments of the sample's FSMs, which collapse_ism.py collapses.
+
+python benchmarks/synthetic_cohort.py --out /tmp/cohort --samples 50 --isoforms 5000
+"""
+
+CHROMS = [f"chr{i}" for i in range(1, 23)]
+TRANSCRIPTS_PER_GENE = 3
+MONO_EXON_RATE = 0.1
+FSM_RATE = 0.5
+FSM_SUBCATEGORIES = ["reference_match", "alternative_3end", "alternative_5end", "alternative_3end5end"]
+NOVEL_CATEGORIES = [
+    ("novel_not_in_catalog", "at_least_one_novel_splicesite"),
+    ("novel_in_catalog", "combination_of_known_splicesites"),
+    ("novel_in_catalog", "intron_retention")
+]
+MONO_CATEGORIES = [("genic", "mono-exon"), ("intergenic", "mono-exon"), ("antisense", "mono-exon")]
+PARAMS_FILE = "cohort.json"
+
+def build_pool(size, rng):
+    """
+    Junction chain pool: per-transcript chrom, strand, annotation and exons
+    (flattened starts/ends with offsets).
+    """
+    exons_n = np.where(rng.random(size) < MONO_EXON_RATE, 1, 2 + np.minimum(rng.poisson(5, size), 28))
+    offsets = np.concatenate(([0], np.cumsum(exons_n)))
+    total = offsets[-1]
+    exon_len = 50 + rng.geometric(1 / 150, total)
+    intron_len = 80 + rng.lognormal(7, 1, total).astype(np.int64)
+    # Exon starts relative to the transcript start: previous exons and introns
+    step = exon_len + intron_len
+    within = np.cumsum(step) - step
+    rel_start = within - np.repeat(within[offsets[:-1]], exons_n)
+    span = np.add.reduceat(step, offsets[:-1]) - intron_len[offsets[1:] - 1]
+
+    # Transcripts of a gene overlap; genes are laid out along their chromosome
+    gene = np.arange(size) // TRANSCRIPTS_PER_GENE
+    n_genes = gene[-1] + 1
+    shift = rng.integers(0, 2000, size)
+    gene_span = np.zeros(n_genes, dtype=np.int64)
+    np.maximum.at(gene_span, gene, shift + span)
+    gene_chrom = np.arange(n_genes) % len(CHROMS)
+    gene_start = np.zeros(n_genes, dtype=np.int64)
+    for c in range(len(CHROMS)):
+        genes = np.flatnonzero(gene_chrom == c)
+        widths = gene_span[genes] + 5000
+        gene_start[genes] = 10_000 + np.cumsum(widths) - widths
+    tx_start = gene_start[gene] + shift
+
+    starts = np.repeat(tx_start, exons_n) + rel_start
+    kind = np.where(exons_n == 1, "mono", np.where(rng.random(size) < FSM_RATE, "fsm", "novel"))
+    return {
+        "size": size,
+        "exons_n": exons_n,
+        "offsets": offsets,
+        "starts": starts,
+        "ends": starts + exon_len - 1,
+        "chrom": np.array(CHROMS)[gene_chrom[gene]],
+        "strand": np.where(rng.random(n_genes) < 0.5, "+", "-")[gene],
+        "gene_index": gene,
+        "gene": np.char.add("ENSGSYN", np.char.zfill(gene.astype(str), 9)),
+        "kind": kind,
+        "transcript": np.where(kind == "fsm", np.char.add("ENSTSYN", np.char.zfill(np.arange(size).astype(str), 9)), "novel"),
+        "subcategory": rng.integers(0, 12, size),
+        "abundance": rng.lognormal(1.5, 1.5, size)
+    }
+
+def sample_isoforms(pool, core, n_private, n_ism, rng):
+    """
+    Isoforms of one sample as (pool entry, first exon, last exon + 1, ISM
+    subcategory or ""): the core entries, private entries drawn from the rest
+    of the pool, and ISM fragments of the sample's multi-exon FSMs.
+    """
+    rest = rng.choice(np.arange(len(core), pool["size"]), n_private, replace=False)
+    entries = np.concatenate((core, np.sort(rest)))
+    first = np.zeros(len(entries), dtype=np.int64)
+    last = pool["exons_n"][entries].copy()
+    ism = np.full(len(entries), "", dtype=object)
+
+    parents = entries[(pool["kind"][entries] == "fsm") & (pool["exons_n"][entries] >= 3)]
+    if n_ism and len(parents):
+        parent = rng.choice(parents, n_ism)
+        exons_n = pool["exons_n"][parent]
+        dropped = rng.integers(1, np.minimum(exons_n - 1, 3) + 1)
+        three_prime = rng.random(n_ism) < 0.7
+        # a 3' fragment lacks 5' exons: the first exons on +, the last ones on -
+        drop_low = three_prime == (pool["strand"][parent] == "+")
+        entries = np.concatenate((entries, parent))
+        first = np.concatenate((first, np.where(drop_low, dropped, 0)))
+        last = np.concatenate((last, np.where(drop_low, exons_n, exons_n - dropped)))
+        ism = np.concatenate((ism, np.where(three_prime, "3prime_fragment", "5prime_fragment")))
+    return entries, first, last, ism
+
+def sample_tables(pool, name, entries, first, last, ism, rng):
+    """classification, junctions, GTF and abundance tables of one sample."""
+    n = len(entries)
+    exons_n = last - first
+    index = np.repeat(pool["offsets"][entries] + first - np.cumsum(exons_n) + exons_n, exons_n) + np.arange(exons_n.sum())
+    owner = np.repeat(np.arange(n), exons_n)
+    starts, ends = pool["starts"][index], pool["ends"][index]
+    bounds = np.concatenate(([0], np.cumsum(exons_n)))[:-1]
+    isoform = np.char.add(f"PB.{name}.", np.arange(1, n + 1).astype(str))
+    chrom, strand = pool["chrom"][entries], pool["strand"][entries]
+    kind = pool["kind"][entries]
+
+    category = np.empty(n, dtype=object)
+    subcategory = np.empty(n, dtype=object)
+    sub = pool["subcategory"][entries]
+    fsm, novel, mono = kind == "fsm", kind == "novel", kind == "mono"
+    category[fsm] = "full-splice_match"
+    subcategory[fsm] = np.array(FSM_SUBCATEGORIES)[sub[fsm] % len(FSM_SUBCATEGORIES)]
+    category[novel] = [NOVEL_CATEGORIES[s % len(NOVEL_CATEGORIES)][0] for s in sub[novel]]
+    subcategory[novel] = [NOVEL_CATEGORIES[s % len(NOVEL_CATEGORIES)][1] for s in sub[novel]]
+    category[mono] = [MONO_CATEGORIES[s % len(MONO_CATEGORIES)][0] for s in sub[mono]]
+    subcategory[mono] = "mono-exon"
+    is_ism = ism != ""
+    category[is_ism] = "incomplete-splice_match"
+    subcategory[is_ism] = ism[is_ism]
+
+    length = np.add.reduceat(ends - starts + 1, bounds)
+    classification = pd.DataFrame({
+        "isoform": isoform,
+        "chrom": chrom,
+        "strand": strand,
+        "length": length,
+        "exons": exons_n,
+        "structural_category": category,
+        "associated_gene": pool["gene"][entries],
+        "associated_transcript": pool["transcript"][entries],
+        "ref_length": np.add.reduceat(pool["ends"] - pool["starts"] + 1, pool["offsets"][:-1])[entries],
+        "ref_exons": pool["exons_n"][entries],
+        "subcategory": subcategory,
+        "FL": np.maximum(1, rng.poisson(5, n))
+    })
+
+    # Junctions: introns between consecutive exons of an isoform
+    intron = np.flatnonzero(owner[1:] == owner[:-1])
+    junction_owner = owner[intron]
+    junction_rank = intron - bounds[junction_owner] + 1
+    junctions = pd.DataFrame({
+        "isoform": isoform[junction_owner],
+        "chrom": chrom[junction_owner],
+        "strand": strand[junction_owner],
+        "junction_number": np.char.add("junction_", junction_rank.astype(str)),
+        "genomic_start_coord": ends[intron] + 1,
+        "genomic_end_coord": starts[intron + 1] - 1,
+        "junction_category": np.where(kind[junction_owner] == "novel", "novel", "known"),
+        "canonical": "canonical"
+    })
+
+    # GTF: a transcript record followed by its exons, in ascending order
+    gene_id = np.char.add("PB.", (pool["gene_index"][entries] + 1).astype(str))
+    transcript_attr = np.char.add(np.char.add(np.char.add('transcript_id "', isoform), '"; gene_id "'), gene_id)
+    exon_attr = np.char.add(transcript_attr, '";')[owner]
+    transcript_attr = np.char.add(transcript_attr, '"')
+    gtf = pd.DataFrame({
+        "chr": np.concatenate((chrom, chrom[owner])),
+        "source": "PacBio",
+        "feature": np.repeat(["transcript", "exon"], [n, len(owner)]),
+        "start": np.concatenate((starts[bounds], starts)),
+        "end": np.concatenate((ends[bounds + exons_n - 1], ends)),
+        "score": ".",
+        "strand": np.concatenate((strand, strand[owner])),
+        "frame": ".",
+        "attribute": np.concatenate((transcript_attr, exon_attr))
+    })
+    order = np.argsort(np.concatenate((np.arange(n), owner)), kind="stable")
+    gtf = gtf.iloc[order]
+
+    abundance = pd.DataFrame({
+        "isoform": isoform,
+        "count": np.maximum(1, rng.poisson(pool["abundance"][entries] * rng.lognormal(0, 0.5, n)))
+    })
+    return classification, junctions, gtf, abundance
+
+def generate_cohort(out, samples, isoforms=5000, overlap=0.5, ism_rate=0.2, expression=True, seed=0):
+    """
+    Write a synthetic cohort to out and return the path of its input file.
+    A cohort generated before with the same parameters is reused.
+    """
+    params = {"samples": samples, "isoforms": isoforms, "overlap": overlap,
+              "ism_rate": ism_rate, "expression": expression, "seed": seed}
+    out = os.path.abspath(out)
+    input_file = os.path.join(out, "input_files.txt")
+    params_path = os.path.join(out, PARAMS_FILE)
+    if os.path.exists(params_path) and os.path.exists(input_file):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return input_file
+    os.makedirs(out, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    n_ism = round(ism_rate * isoforms)
+    n_core = round(overlap * (isoforms - n_ism))
+    n_private = isoforms - n_ism - n_core
+    pool = build_pool(n_core + max(samples * n_private, 1), rng)
+    core = np.arange(n_core)
+
+    rows = []
+    for s in range(samples):
+        name = f"synth{s + 1:03d}"
+        tables = sample_tables(pool, name, *sample_isoforms(pool, core, n_private, n_ism, rng), rng)
+        paths = [os.path.join(out, f"{name}_{suffix}")
+                 for suffix in ("classification.txt", "junctions.txt", "corrected.gtf", "abundance.tsv")]
+        classification, junctions, gtf, abundance = tables
+        classification.to_csv(paths[0], sep="\t", index=False)
+        junctions.to_csv(paths[1], sep="\t", index=False)
+        gtf.to_csv(paths[2], sep="\t", index=False, header=False, quoting=csv.QUOTE_NONE)
+        if expression:
+            abundance.to_csv(paths[3], sep="\t", index=False, header=False)
+        rows.append(paths if expression else paths[:3])
+
+    with open(input_file, "w") as f:
+        f.writelines("\t".join(row) + "\n" for row in rows)
+    with open(params_path, "w") as f:
+        json.dump(params, f, indent=1)
+    return input_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic cohort of SQANTI3 outputs")
+    parser.add_argument("--out", required=True,
+                        help="Output folder; the sq_compare.py input file is written to <out>/input_files.txt")
+    parser.add_argument("--samples", type=int, default=5,
+                        help="Number of samples")
+    parser.add_argument("--isoforms", type=int, default=5000,
+                        help="Isoforms per sample")
+    parser.add_argument("--overlap", type=float, default=0.5,
+                        help="Fraction of the non-ISM isoforms shared by all samples")
+    parser.add_argument("--ism_rate", type=float, default=0.2,
+                        help="Fraction of isoforms that are ISM fragments of the sample's FSMs")
+    parser.add_argument("--no_expression", action="store_true",
+                        help="Do not write abundance files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    input_file = generate_cohort(args.out, args.samples, args.isoforms, args.overlap, args.ism_rate,
+                                 not args.no_expression, args.seed)
+    print(f"Synthetic cohort of {args.samples} samples written; input file: {input_file}")
+
+if __name__ == "__main__":
+    main()
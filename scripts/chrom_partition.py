@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
+from universal_id import standardize_isoforms_cross_sample, write_standardized_tables, register_chain_key, GTF_CATEGORICAL
+from generalize_isoforms import build_catalog, CATALOG_COLUMNS
+from ujc_catalog import concat_catalogs, expression_rows
+
+"""
+Chromosome-partitioned universal ID assignment and matrix build
+(sq_compare.py --partition_by_chrom). A junction chain never spans
+chromosomes, so every sample's GTF exons, classification, junctions and
+expression rows are split into shards of whole chromosomes, and each shard
+runs the usual stage functions on its own, in parallel. Universal IDs
+depend on the chain only, so the concatenated shards are identical to an
+unpartitioned run.
+
+Chromosomes are packed into at most 2 x workers shards, largest first, so
+a shard holds about max(largest chromosome, genome / (2 x workers)) rows
+of every sample; shards are created as workers free up.
+"""
+
+TABLES = ["classification", "junctions", "expression"]
+
+def _pack_chroms(codes, workers):
+    """
+    chrom -> shard number, packing chromosomes (by their number of rows in
+    `codes`) into at most 2 x workers shards with the least-loaded-first rule.
+    """
+    sizes = pd.concat(codes).value_counts()
+    if sizes.empty:
+        return {}
+    cap = max(sizes.iloc[0], sizes.sum() / (2 * workers))
+    loads = np.zeros(min(len(sizes), int(np.ceil(sizes.sum() / cap))))
+    shard_of = {}
+    for chrom, size in sizes.items():
+        shard = int(np.argmin(loads))
+        loads[shard] += size
+        shard_of[chrom] = shard
+    return shard_of
+
+def _map_shards(func, shards, workers):
+    """
+    func over (shard number, shard) pairs, on `workers` processes; shards
+    are created as workers free up. Returns shard number -> result.
+    """
+    if workers <= 1:
+        return {i: func(shard) for i, shard in shards}
+    results, pending = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, shard in shards:
+            pending[i] = pool.submit(func, shard)
+            if len(pending) > workers:
+                done = next(iter(pending))
+                results[done] = pending.pop(done).result()
+        results.update({i: future.result() for i, future in pending.items()})
+    return results
+
+def _shard_rows(shards):
+    """Row positions of every shard number in an array of shard numbers (NaN: no shard)."""
+    shards = np.asarray(shards, dtype=float)
+    keep = np.flatnonzero(~np.isnan(shards))
+    order = keep[np.argsort(shards[keep], kind="stable")]
+    numbers, starts = np.unique(shards[order], return_index=True)
+    return dict(zip(numbers.astype(int), np.split(order, starts[1:])))
+
+def _reassemble(parts, rows):
+    """Concatenate the shard tables of one sample table back into its row order."""
+    table = pd.concat(parts)
+    return table.iloc[np.argsort(np.concatenate(rows), kind="stable")]
+
+def _compact(exons):
+    """Exon rows with only their own transcript IDs (and chromosomes) as categories."""
+    columns = {}
+    for col in GTF_CATEGORICAL:
+        values = exons[col].array
+        used = np.unique(values.codes[values.codes >= 0])
+        codes = np.where(values.codes >= 0, np.searchsorted(used, values.codes), -1)
+        columns[col] = pd.Categorical.from_codes(codes, values.categories[used])
+    return exons.assign(**columns)
+
+def _split(data, row_shards, n_shards, columns=None, extra=None):
+    """
+    Yield (shard number, shard) pairs: SQANTI3 objects holding the rows of
+    each sample in that shard. row_shards gives the shard number of each
+    row of sample -> table; tables it does not cover are None.
+    extra(shard number, sample) adds further per-sample entries (e.g. the GTF).
+    """
+    positions = {
+        sample: {table: _shard_rows(shards) for table, shards in tables.items()}
+        for sample, tables in row_shards.items()
+    }
+    empty = np.array([], dtype=np.int64)
+    for i in range(n_shards):
+        shard = {"samples": data["samples"], "n_samples": data["n_samples"], "data": {}}
+        for sample in data["samples"]:
+            tables = data["data"][sample]
+            shard_tables = dict.fromkeys(TABLES)
+            for table, rows in positions[sample].items():
+                df = tables[table]
+                if columns and table in columns:
+                    df = df[[c for c in columns[table] if c in df.columns]]
+                shard_tables[table] = df.iloc[rows.get(i, empty)]
+            if extra:
+                shard_tables.update(extra(i, sample))
+            shard["data"][sample] = shard_tables
+        yield i, shard
+
+def _standardize_shard(shard, keep_registry=False, **options):
+    """
+    Universal IDs of one shard; returns the shard, its number of chains per
+    sample and, with keep_registry, its chain keys (see standardize_by_chrom).
+    """
+    counts = {
+        sample: len(tables["chains"]) if tables.get("chains") is not None else tables["gtf"]["transcript_id"].nunique()
+        for sample, tables in shard["data"].items()
+    }
+    registry = {}
+    shard = standardize_isoforms_cross_sample(shard, verbose=False, registry=registry, **options)
+    return shard, counts, registry if keep_registry else None
+
+def standardize_by_chrom(data, out_dir, workers=1, registry=None, **options):
+    """
+    standardize_isoforms_cross_sample (with keyword `options`), run on
+    shards of chromosomes on `workers` processes. Rows are assigned to the
+    chromosome of their transcript in the sample's GTF; rows of transcripts
+    missing from the GTF (which get no universal ID) go with the first shard.
+    The chain keys of the shards are added to `registry` if given (chains of
+    different shards are on different chromosomes, so their keys are only
+    compared there).
+    """
+    tx_chroms = {}
+    for sample in data["samples"]:
+        gtf = data["data"][sample]["gtf"]
+        tx_chrom = pd.Series(gtf["chr"].astype(str).to_numpy(), index=gtf["transcript_id"].astype(str).to_numpy())
+        tx_chroms[sample] = tx_chrom[~tx_chrom.index.duplicated()]
+    shard_of = _pack_chroms(list(tx_chroms.values()), workers)
+    n_shards = max(shard_of.values(), default=0) + 1
+
+    row_shards = {}
+    for sample in data["samples"]:
+        tables = data["data"][sample]
+        tx_shard = tx_chroms[sample].map(shard_of)
+        row_shards[sample] = {
+            table: (tables[table].iloc[:, 0] if table == "expression" else tables[table]["isoform"])
+                   .map(tx_shard).fillna(0).to_numpy()
+            for table in TABLES if tables.get(table) is not None
+        }
+
+    # Each sample's chains (cached) or GTF exons are split once, then handed out per shard
+    sample_parts = {}
+    for sample in data["samples"]:
+        tables = data["data"][sample]
+        no_exons = _compact(tables["gtf"].iloc[:0])
+        if tables.get("chains") is not None:
+            chains = {}
+            for tid, chain in tables["chains"].items():
+                chains.setdefault(shard_of[chain[0]], {})[tid] = chain
+            sample_parts[sample] = (no_exons, None, chains)
+        else:
+            gtf = tables["gtf"]
+            shard_codes = np.array([shard_of.get(c, np.nan) for c in gtf["chr"].cat.categories] + [np.nan])
+            rows = _shard_rows(shard_codes[gtf["chr"].cat.codes])
+            sample_parts[sample] = (no_exons, {i: _compact(gtf.iloc[r]) for i, r in rows.items()}, None)
+
+    def sample_gtf(i, sample):
+        no_exons, exons, chains = sample_parts[sample]
+        if chains is not None:
+            return {"gtf": no_exons, "chains": chains.get(i, {})}
+        return {"gtf": exons.get(i, no_exons)}
+
+    shards = _split(data, row_shards, n_shards, extra=sample_gtf)
+    results = _map_shards(partial(_standardize_shard, keep_registry=registry is not None, **options), shards, workers)
+    if registry is not None:
+        for _, _, shard_keys in results.values():
+            for key, chain in shard_keys.items():
+                register_chain_key(registry, key, chain)
+
+    for sample in data["samples"]:
+        tables = data["data"][sample]
+        for table, shards in row_shards[sample].items():
+            rows = _shard_rows(shards)
+            tables[table] = _reassemble([results[i][0]["data"][sample][table] for i in rows], list(rows.values()))
+        n_chains = sum(counts[sample] for _, counts, _ in results.values())
+        print(f"Extracted {n_chains} junction chains for sample {sample}")
+    print(f"Assigned universal IDs in {n_shards} shards of {len(shard_of)} chromosomes")
+
+    if out_dir is not None:
+        write_standardized_tables(data, out_dir)
+    return data
+
+def build_catalog_by_chrom(data, workers=1):
+    """
+    build_catalog, run on shards of chromosomes on `workers` processes and
+    concatenated. Classification rows are assigned to the chromosome of
+    their junction chain, expression rows to that of their universal ID.
+    """
+    chroms = {s: data["data"][s]["classification"]["junction_chain"].str[0] for s in data["samples"]}
+    shard_of = _pack_chroms(list(chroms.values()), workers)
+    n_shards = max(shard_of.values(), default=0) + 1
+
+    uid_shard = {}
+    row_shards = {}
+    for sample in data["samples"]:
+        class_df = data["data"][sample]["classification"]
+        shards = chroms[sample].map(shard_of)
+        uid_shard.update(zip(class_df["universal_id"], shards))
+        row_shards[sample] = {"classification": shards.to_numpy()}
+    uid_shard = pd.Series(uid_shard)
+    for sample in data["samples"]:
+        expr_df = data["data"][sample].get("expression")
+        if expr_df is not None:
+            # expression of chains no classification has is dropped by build_catalog
+            row_shards[sample]["expression"] = expr_df["universal_id"].map(uid_shard).to_numpy()
+
+    shards = _split(data, row_shards, n_shards, columns={"classification": CATALOG_COLUMNS})
+    results = _map_shards(build_catalog, shards, workers)
+    print(f"Built the isoform matrix in {n_shards} shards of {len(shard_of)} chromosomes")
+    catalog = concat_catalogs([results[i] for i in range(n_shards)], data["samples"])
+    # the raw expression rows of the samples are kept whole, in input order
+    catalog["expression"] = {
+        sample: expression_rows(data["data"][sample]["expression"]) for sample in data["samples"]
+        if data["data"][sample].get("expression") is not None
+    }
+    return catalog
@@ -1,61 +1,75 @@
 import os
 import argparse
-import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
 import pandas as pd
+from intermediate_store import read_store, write_store
+from run_metrics import timed
 #from collections import defaultdict
 
 
+# Survivor priority by subcategory (lower index wins)
+FSM_PRIORITY = ["reference_match", "alternative_5end", "alternative_3end", "alternative_3end5end"]
+ISM_PRIORITY = ["5prime_fragment", "3prime_fragment", "internal_fragment"]
+
+
 def collapse_ISM(sample, class_df, junc_df, expr_df=None):
-    collapsed_dict = {}
-    kept = []
-    dropped = []
-
-    # Group by associated_transcript
-    for at, group in class_df.groupby("associated_transcript"):
-        if at == "novel":
-            kept.extend(group["isoform"].tolist())
-            continue
-
-        if len(group) == 1:
-            kept.extend(group["isoform"].tolist())
-            continue
-
-        # case handling
-        sc = group["structural_category"].tolist()
-        isoforms = group["isoform"].tolist()
-
-        # Case 1: FSM present
-        if "full_splice_match" in sc:
-            fsm = group[group["structural_category"] == "full_splice_match"]
-
-            if len(fsm) == 1:
-                survivor = fsm.iloc[0]["isoform"]
-            else:
-                # multiple FSMs -> use subcategory priority
-                priority = ["reference_match", "alternative_5end", "alternative_3end", "alternative_3end5end"]
-                fsm_sorted = fsm.sort_values(
-                    by="subcategory",
-                    key=lambda col: col.map(lambda x: priority.index(x) if x in priority else len(priority))
-                )
-                survivor = fsm_sorted.iloc[0]["isoform"]
-
-            removed = [i for i in isoforms if i != survivor]
-            collapsed_dict[survivor] = removed
-            kept.append(survivor)
-            dropped.extend(removed)
-
-        # Case 2: Only ISMs
-        else:
-            priority = ["5prime_fragment", "3prime_fragment", "internal_fragment"]
-            ism_sorted = group.sort_values(
-                by="subcategory",
-                key=lambda col: col.map(lambda x: priority.index(x) if x in priority else len(priority))
-            )
-            survivor = ism_sorted.iloc[0]["isoform"]
-            removed = [i for i in isoforms if i != survivor]
-            collapsed_dict[survivor] = removed
-            kept.append(survivor)
-            dropped.extend(removed)
+    at = class_df["associated_transcript"]
+
+    # Only reference transcripts with several isoforms collapse
+    candidates = class_df[at.notna() & (at != "novel")]
+    group_size = candidates.groupby("associated_transcript")["isoform"].transform("size")
+    multi = candidates[group_size > 1]
+
+    # Case 1: FSM present -> survivor is the best FSM by subcategory priority
+    # Case 2: Only ISMs -> survivor is the best isoform by ISM priority
+    subcat = multi["subcategory"].astype(object)
+    is_fsm = multi["structural_category"] == "full_splice_match"
+    has_fsm = is_fsm.groupby(multi["associated_transcript"]).transform("any")
+    fsm_rank = subcat.map({s: i for i, s in enumerate(FSM_PRIORITY)}).fillna(len(FSM_PRIORITY))
+    ism_rank = subcat.map({s: i for i, s in enumerate(ISM_PRIORITY)}).fillna(len(ISM_PRIORITY))
+    rank = np.where(has_fsm, np.where(is_fsm, fsm_rank, np.nan), ism_rank)
+
+    # Candidates in row order: the FSMs of FSM groups, every isoform otherwise
+    cand = pd.DataFrame({
+        "associated_transcript": multi["associated_transcript"].values,
+        "isoform": multi["isoform"].values,
+        "rank": rank
+    }).dropna(subset=["rank"])
+    best = cand.groupby("associated_transcript")["rank"].transform("min")
+    n_best = (cand["rank"] == best).groupby(cand["associated_transcript"]).transform("sum")
+
+    # A single best candidate is the survivor
+    unique = cand[(cand["rank"] == best) & (n_best == 1)]
+    survivors = dict(zip(unique["associated_transcript"], unique["isoform"]))
+
+    # Ties are broken as the per-transcript sort_values did: first entry of a
+    # quicksort argsort of the group's ranks
+    tied = cand[n_best > 1].sort_values("associated_transcript", kind="mergesort")
+    if not tied.empty:
+        at_values = tied["associated_transcript"].to_numpy()
+        starts = np.flatnonzero(np.r_[True, at_values[1:] != at_values[:-1]])
+        ranks = np.split(tied["rank"].to_numpy(dtype=np.int64), starts[1:])
+        isoforms = np.split(tied["isoform"].to_numpy(), starts[1:])
+        for t, r, iso in zip(at_values[starts], ranks, isoforms):
+            survivors[t] = iso[np.argsort(r, kind="quicksort")[0]]
+
+    # Inverted index: removed isoform -> survivor (row order kept within each transcript)
+    removed = pd.DataFrame({
+        "associated_transcript": multi["associated_transcript"].values,
+        "isoform": multi["isoform"].values
+    })
+    removed["survivor"] = removed["associated_transcript"].map(survivors)
+    removed = removed[removed["isoform"] != removed["survivor"]]
+    survivor_of = dict(zip(removed["isoform"], removed["survivor"]))
+
+    collapsed_dict = {
+        survivors[t]: isoforms
+        for t, isoforms in removed.groupby("associated_transcript", sort=True)["isoform"].agg(list).items()
+    }
+    dropped = removed["isoform"].tolist()
+    kept = class_df.loc[at.notna() & ~class_df["isoform"].isin(survivor_of), "isoform"]
 
     # Update classification
     class_df = class_df[class_df["isoform"].isin(kept)]
@@ -63,13 +77,13 @@ def collapse_ISM(sample, class_df, junc_df, expr_df=None):
     # Update junctions
     junc_df = junc_df[~junc_df["isoform"].isin(dropped)]
 
-    # Update expression
+    # Update expression: counts of removed isoforms are summed into their survivor
     if expr_df is not None:
-        expr_df = expr_df.copy()
-        expr_df['survivor'] = expr_df.iloc[:, 0].map(lambda x: next((s for s, r in collapsed_dict.items() if x in r), x))
-        expr_df = expr_df.groupby('survivor').agg({expr_df.columns[0]: 'first', expr_df.columns[1]: 'sum'}).reset_index(drop=True)
-        expr_df.rename(columns={'survivor': expr_df.columns[0]}, inplace=True)
-        expr_df = expr_df[expr_df[expr_df.columns[0]].isin(kept)]
+        id_col, count_col = expr_df.columns[:2]
+        ids = expr_df[id_col]
+        survivor = ids.map(survivor_of).fillna(ids).rename(id_col)
+        expr_df = expr_df.groupby(survivor)[count_col].sum().reset_index()
+        expr_df = expr_df[expr_df[id_col].isin(kept)]
     sample_dict={sample: collapsed_dict}
     return class_df, junc_df, expr_df, sample_dict
 
@@ -79,58 +93,87 @@ def save_file(df, out, sample, suffix):
     df.to_csv(out_path, sep="\t", index=False)
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Collapse ISM isoforms per sample")
-    parser.add_argument("--pickle", required=True, help="Pickle file containing parsed dataframes")
-    parser.add_argument("--out", required=True, help="Output folder")
-    args = parser.parse_args()
+def collapse_sample(sample, tables):
+    """
+    Collapse ISMs of one sample and filter its GTF (and chains) to the kept isoforms.
+    Returns (updated tables, {sample: collapsed_dict}).
+    """
+    class_df, junc_df, expr_df, collapsed_dict = collapse_ISM(
+        sample, tables['classification'], tables['junctions'], tables.get('expression'))
 
-    os.makedirs(args.out, exist_ok=True)
+    # Filter GTF on the transcript IDs extracted when it was read
+    gtf_df = tables['gtf']
+    gtf_df = gtf_df[gtf_df['transcript_id'].isin(class_df['isoform'])]
+
+    updated = dict(tables, classification=class_df, junctions=junc_df, gtf=gtf_df)
+    if tables.get('chains') is not None:
+        kept_ids = set(class_df['isoform'])
+        updated['chains'] = {t: c for t, c in tables['chains'].items() if t in kept_ids}
+    if expr_df is not None:
+        updated['expression'] = expr_df
+    return updated, collapsed_dict
+
+
+def collapse_samples(data, out, append=False, workers=1, sample_metrics=None):
+    """
+    Collapse ISMs in every sample of a parsed SQANTI3 object (in place)
+    and write ISMcollapsed_summary.tsv to the output folder
+    (adding to an existing summary if append is set, replacing the rows
+    of these samples).
+    Samples are processed in `workers` processes; their wall time, CPU time
+    and peak RSS are added to sample_metrics if given.
+    """
+    samples = data['samples']
+    tables = [data['data'][sample] for sample in samples]
+    if workers > 1 and len(samples) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(samples))) as pool:
+            results = list(pool.map(partial(timed, collapse_sample), samples, tables))
+    else:
+        results = [timed(collapse_sample, sample, t) for sample, t in zip(samples, tables)]
 
-    with open(args.pickle, "rb") as f:
-        data = pickle.load(f)
-        for sample in data['samples']:
-            class_df=data['data'][sample]['classification']
-            junc_df=data['data'][sample]['junctions']
-            gtf_df=data['data'][sample]['gtf']
-            expr_df=data['data'][sample]['expression'] if 'expression' in data['data'][sample] else None
-            
-            # Collapse
-            class_df, junc_df, expr_df, collapsed_dict = collapse_ISM(sample, class_df, junc_df, expr_df)
-            #save_file(class_df, args.out, sample, "classification")
-            #save_file(junc_df, args.out, sample, "junctions")
-            #save_file(expr_df, args.out, sample, "expression") if expr_df is not None else None
-
-            # Filter GTF
-            attr=gtf_df[8]
-            gtf_df['transcript_id'] = attr.str.extract('transcript_id "([^"]+)"')
-            gtf_df = gtf_df[gtf_df['transcript_id'].isin(class_df['isoform'])]
-
-            # Update sample data in pickle with collapsed files
-            data['data'][sample]['classification'] = class_df
-            data['data'][sample]['junctions'] = junc_df
-            data['data'][sample]['gtf'] = gtf_df.drop(columns=['transcript_id'])
-            if expr_df is not None:
-                data['data'][sample]['expression'] = expr_df
-
-            print(f"Processed sample {sample}: Kept {len(class_df)} isoforms.")  
-
-    # Save collapsed summary
-    summary_path = os.path.join(args.out, "ISMcollapsed_summary.tsv")
+    collapsed_dict = {}
+    for sample, ((updated, sample_dict), m) in zip(samples, results):
+        if sample_metrics is not None:
+            sample_metrics[sample] = m
+        data['data'][sample] = updated
+        collapsed_dict.update(sample_dict)
+        print(f"Processed sample {sample}: Kept {len(updated['classification'])} isoforms.")
+
+    # Save collapsed summary; rows of these samples written by an earlier
+    # (e.g. interrupted) run are replaced, so a rerun does not duplicate them
+    summary_path = os.path.join(out, "ISMcollapsed_summary.tsv")
+    previous = []
+    if append and os.path.exists(summary_path):
+        processed = set(samples)
+        with open(summary_path) as f:
+            next(f, None)
+            previous = [line for line in f if line.split("\t", 1)[0] not in processed]
     with open(summary_path, "w") as f:
         f.write("sample\tsurvivor_isoform\tcollapsed_isoforms\n")
+        f.writelines(previous)
         for sample, transcripts in collapsed_dict.items():
             for survivor, removed in transcripts.items():
                 if removed:  # only log when something collapsed
                     f.write(f"{sample}\t{survivor}\t{','.join(removed)}\n")
-   
-    # Replace old pickle 
-    with open(f'{args.out}/sqanti3_samples_ISMcollapsed.pkl', "wb") as f:
-        pickle.dump(data, f)
-
-    #print(f"Collapsed ISMs. Updated files saved to {args.out}. Pickle updated.")
     print(f"Collapsed summary written to {summary_path}")
 
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collapse ISM isoforms per sample")
+    parser.add_argument("--store", required=True, help="Intermediate store with parsed dataframes (e.g. <out>/sqanti3_samples)")
+    parser.add_argument("--out", required=True, help="Output folder")
+    parser.add_argument("--workers", type=int, default=1, help="Number of samples to collapse in parallel (default: 1)")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    data = read_store(args.store)
+    collapse_samples(data, args.out, workers=args.workers)
+
+    write_store(data, os.path.join(args.out, "sqanti3_samples_ISMcollapsed"))
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
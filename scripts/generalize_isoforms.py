@@ -1,14 +1,197 @@
 #!/usr/bin/env python3
 import os
 import argparse
-import pickle
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from intermediate_store import read_store
+from universal_id import keys_for_universal_ids, universal_id_for_key, split_chain
+from ujc_index import write_ujc_index
+from ujc_catalog import expression_rows
+from tmm_norm import normalize_matrix, read_norm_factors
+
+# Classification columns used to build the catalog
+CATALOG_COLUMNS = ["isoform", "universal_id", "junction_chain", "structural_category",
+                   "associated_gene", "associated_transcript", "exons", "length"]
+
+# Rows of isoform_matrix.tsv densified and written at a time
+MATRIX_CHUNK_ROWS = 100_000
+
+def sparse_matrix(index, row_ids, samples, sample_of, values, dtype):
+    """
+    Scatter (row ID, sample, value) triplets into a DataFrame of sparse
+    columns (fill value 0) with rows `index` and columns `samples`.
+    Duplicated cells are summed; row IDs not in `index` are dropped.
+    """
+    rows = index.get_indexer(row_ids)
+    cols = pd.Index(samples).get_indexer(sample_of)
+    keep = rows >= 0
+    coo = sp.coo_matrix(
+        (np.asarray(values, dtype=dtype)[keep], (rows[keep], cols[keep])),
+        shape=(len(index), len(samples))
+    )
+    return pd.DataFrame.sparse.from_spmatrix(coo.tocsc(), index=index, columns=samples)
+
+def take_rows(matrix, rows):
+    """Select matrix rows by position, keeping the sparse dtypes (pandas upcasts uint8)."""
+    return matrix.iloc[rows].astype(matrix.dtypes.to_dict())
+
+def render_chain(chrom, coords, labels=()):
+    """Human-readable junction chain, as written to the output tables."""
+    return str(tuple([chrom] + list(labels) + coords.tolist()))
+
+def build_catalog(pickle_df):
+    """
+    Aggregate the classification and expression of all samples by junction chain.
+    Chains are interned once by their integer key (see universal_id.chain_key),
+    and every join and groupby runs on those keys.
+    Returns a UJC catalog dict:
+    - samples : list of sample names (matrix column order)
+    - chains : chain dictionary indexed by chain key with chrom (categorical),
+      labels (tuple: strand and mono-exon mark of intron chains, else empty),
+      coords (int32 array), category, associated_gene, associated_transcript,
+      exons_n, length_sum, length_n
+    - matrix : DataFrame indexed by chain key, one column per sample
+      (sparse raw counts, or uint8 1/0 presence when no expression was
+      given)
+    - expression : sample -> raw expression rows (see ujc_catalog.expression_rows)
+    """
+    all_classifications = []
+    all_expr = {}
+    expression = {}
+    samples = pickle_df["samples"]
+    for sample in samples:
+        class_df = pickle_df["data"][sample]["classification"].copy()
+        class_df["sample"] = sample
+        all_classifications.append(class_df)
+        expr_df = pickle_df["data"][sample]["expression"]
+        if expr_df is not None:
+            expression[sample] = expression_rows(expr_df)
+            expr_df = expr_df.dropna(subset=["universal_id"])
+            all_expr[sample] = pd.Series(expr_df["count"].values,
+                                         index=keys_for_universal_ids(expr_df["universal_id"]))
+
+    combined = pd.concat(all_classifications, ignore_index=True)
+    combined["chain_key"] = keys_for_universal_ids(combined["universal_id"])
+
+    # --- Per-chain metadata; length is kept as sum/count so catalogs can be merged ---
+    chains = (
+        combined
+        .groupby("chain_key")
+        .agg(
+            junction_chain=("junction_chain", "first"),
+            category=("structural_category", "first"),
+            associated_gene=("associated_gene", "first"),
+            associated_transcript=("associated_transcript", "first"),
+            exons_n=("exons", "first"),               # consistent
+            length_sum=("length", "sum"),
+            length_n=("length", "count")
+        )
+    )
+    # chain dictionary: chromosome code + labels + packed coordinates
+    first_chains = [split_chain(c) for c in chains.pop("junction_chain")]
+    chains.insert(0, "chrom", pd.Categorical([c[0] for c in first_chains]))
+    chains.insert(1, "labels", [c[1] for c in first_chains])
+    chains.insert(2, "coords", [np.asarray(c[2], dtype=np.int32) for c in first_chains])
+
+    # --- Isoform matrix (isoforms x samples), sparse ---
+    # expression where available, otherwise uint8 presence/absence
+    parts = []
+    if all_expr:
+        expr = pd.concat(all_expr, names=["sample", "chain_key"]).reset_index(name="count")
+        parts.append(sparse_matrix(chains.index, expr["chain_key"], list(all_expr),
+                                   expr["sample"], expr["count"], expr["count"].dtype))
+    presence_samples = [s for s in samples if s not in all_expr]
+    if presence_samples:
+        present = combined.loc[combined["sample"].isin(presence_samples), ["chain_key", "sample"]].drop_duplicates()
+        parts.append(sparse_matrix(chains.index, present["chain_key"], presence_samples,
+                                   present["sample"], np.ones(len(present)), np.uint8))
+    matrix = pd.concat(parts, axis=1)[samples] if parts else pd.DataFrame(index=chains.index)
+
+    return {
+        "samples": matrix.columns.tolist(),
+        "chains": chains,
+        "matrix": matrix,
+        "expression": expression
+    }
+
+def catalog_tables(catalog):
+    """
+    Render a UJC catalog as the isoform_info and isoform_matrix tables,
+    ordered by junction chain. Chains and universal IDs are rendered
+    from the chain dictionary here.
+    """
+    chains = catalog["chains"]
+    chroms = chains["chrom"].astype(str).values
+    labels = chains["labels"].values
+    coords = chains["coords"].values
+    order = sorted(range(len(chains)), key=lambda i: (chroms[i], coords[i].tolist(), labels[i]))
+    chains = chains.iloc[order]
+    unique_jc = [render_chain(chroms[i], coords[i], labels[i]) for i in order]
+
+    # --- Isoform info (metadata) ---
+    isoform_info = pd.DataFrame({
+        "unique_jc": unique_jc,
+        "universal_id": [universal_id_for_key(k) for k in chains.index],
+        "category": chains["category"].values,
+        "associated_gene": chains["associated_gene"].values,
+        "associated_transcript": chains["associated_transcript"].values,
+        "exons_n": chains["exons_n"].values,
+        "length": chains["length_sum"].values / chains["length_n"].values   # averaged
+    })
+
+    # --- Isoform matrix, keyed by unique_jc ---
+    matrix = catalog["matrix"]
+    matrix = take_rows(matrix, matrix.index.get_indexer(chains.index))
+    matrix.index = unique_jc
+    matrix.index.name = "unique_jc"
+    matrix = matrix.reset_index()
+
+    return isoform_info, matrix
+
+def write_matrix(matrix, path, chunk_rows=MATRIX_CHUNK_ROWS):
+    """Write a (sparse) matrix as TSV, densifying chunk_rows rows at a time."""
+    sparse_cols = {c: t.subtype for c, t in matrix.dtypes.items() if isinstance(t, pd.SparseDtype)}
+    with open(path, "w") as f:
+        for start in range(0, max(len(matrix), 1), chunk_rows):
+            chunk = matrix.iloc[start:start + chunk_rows].astype(sparse_cols)
+            chunk.to_csv(f, sep="\t", index=False, header=start == 0)
+
+def write_isoform_tables(isoform_info, matrix, out):
+    """Save isoform_info.tsv and isoform_matrix.tsv to <out>/summarized."""
+    os.makedirs(f"{out}/summarized", exist_ok=True)
+    isoform_info.to_csv(os.path.join(f"{out}/summarized", "isoform_info.tsv"), sep="\t", index=False)
+    write_matrix(matrix, os.path.join(f"{out}/summarized", "isoform_matrix.tsv"))
+    print(f"Saved isoform_info.tsv and isoform_matrix.tsv to {out}/summarized")
+
+def write_catalog_tables(catalog, out, factors=None):
+    """
+    Write isoform_info.tsv and isoform_matrix.tsv in <out>/summarized and
+    the UJC index in <out>/ujc_index from a UJC catalog, with the raw
+    counts normalized by TMM factors (see tmm_norm.normalize_samples).
+    Returns (isoform_info, matrix).
+    """
+    if factors is not None:
+        catalog = {**catalog, "matrix": normalize_matrix(catalog["matrix"], factors)}
+    isoform_info, matrix = catalog_tables(catalog)
+    write_isoform_tables(isoform_info, matrix, out)
+    write_ujc_index(catalog, out)
+    return isoform_info, matrix
+
+def generalize_isoforms(pickle_df, out):
+    """
+    Build isoform_info.tsv and isoform_matrix.tsv in <out>/summarized and
+    the UJC index in <out>/ujc_index from a standardized SQANTI3 object,
+    normalizing expression with the factors in <out>/normalized_expression.
+    Returns (isoform_info, matrix).
+    """
+    return write_catalog_tables(build_catalog(pickle_df), out, read_norm_factors(out))
 
 def main():
     parser = argparse.ArgumentParser(description="Create isoform metadata and presence/expression matrices")
     parser.add_argument(
-        "--pickle", required=True,
-        help="Paths to input pickle with classification, junctions, and expression dataframes"
+        "--store", required=True,
+        help="Intermediate store with standardized classification and expression tables (run tmm_norm.py on it first to normalize expression)"
     )
     parser.add_argument(
         "--out", required=True,
@@ -16,75 +199,9 @@ def main():
     )
     args = parser.parse_args()
 
-    os.makedirs(f"{args.out}/summarized", exist_ok=True)
-
-    all_classifications = []
-    all_expr = {}
-    with open(args.pickle, "rb") as f:
-        pickle_df = pickle.load(f)
-        samples = pickle_df["samples"]
-        for sample in samples:
-            class_df = pickle_df["data"][sample]["classification"].copy()
-            class_df["sample"] = sample
-            all_classifications.append(class_df)
-            expr_df = pickle_df["data"][sample]["expression"]
-            if expr_df is not None:
-                expr_df = expr_df[["universal_id", "count"]].copy()
-                all_expr[sample] = expr_df.set_index("universal_id")["count"]
-
-        combined = pd.concat(all_classifications, ignore_index=True)
-        combined["junction_chain"] = combined["junction_chain"].apply(tuple)
-
-        # --- Isoform info (metadata) ---
-        isoform_info = (
-            combined
-            .groupby("junction_chain")
-            .agg({
-                "universal_id": "first",   # consistent across samples
-                "structural_category": "first",
-                "associated_gene": "first",
-                "associated_transcript": "first",
-                "exons": "first",          # consistent
-                "length": "mean"           # averaged
-            })
-            .reset_index()
-            .rename(columns={
-                "junction_chain": "unique_jc",
-                "structural_category": "category",
-                "exons": "exons_n"
-            })
-        )
-
-        # --- Isoform matrix (samples x isoforms) ---
-        isoform_ids = isoform_info["universal_id"].tolist()
-        matrix = pd.DataFrame(index=isoform_ids)
-
-        for sample in combined["sample"].unique():
-            if sample in all_expr:
-                # expression available
-                expr_series = all_expr[sample]
-                if expr_series.index.has_duplicates:
-                    expr_series = expr_series.groupby(expr_series.index).sum()
-                col = expr_series.reindex(isoform_ids).fillna(0)
-                matrix[sample] = col        
-            else:
-                # binary presence/absence
-                present_ids = set(combined.loc[combined["sample"] == sample, "universal_id"])
-                matrix[sample] = [1 if uid in present_ids else 0 for uid in isoform_ids]
-
-        # Replace universal ids with corresponding unique_jc
-        uid_to_jc = dict(zip(isoform_info["universal_id"], isoform_info["unique_jc"]))
-        matrix.index = matrix.index.map(lambda uid: str(uid_to_jc.get(uid, uid)))
-        #matrix.index = matrix.index.map(uid_to_jc)
-        matrix.index.name = "unique_jc"
-        matrix = matrix.reset_index().rename(columns={"index": "unique_jc"})
-
-        # --- Save ---
-        isoform_info.to_csv(os.path.join(f"{args.out}/summarized", "isoform_info.tsv"), sep="\t", index=False)
-        matrix.to_csv(os.path.join(f"{args.out}/summarized", "isoform_matrix.tsv"), sep="\t", index=False)
-        print(f"Saved isoform_info.tsv and isoform_matrix.tsv to {args.out}/summarized")
-        with open(os.path.join(args.out, "combined.pkl"), "wb") as f:
-            pickle.dump({"isoform_info": isoform_info, "isoform_matrix": matrix}, f)
+    pickle_df = read_store(args.store, tables=["classification", "expression"],
+                           columns={"classification": CATALOG_COLUMNS})
+    generalize_isoforms(pickle_df, args.out)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
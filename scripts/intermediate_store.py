@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+"""
+Columnar store for the per-stage SQANTI3 objects ({"samples", "data"}).
+
+Each table type is a Parquet dataset partitioned by sample:
+
+<store>/
+    manifest.json                                   samples, tables, base store
+    classification/sample=<name>/part-0.parquet
+    junctions/sample=<name>/part-0.parquet
+    gtf/sample=<name>/part-0.parquet
+    expression/sample=<name>/part-0.parquet        (absent when no expression)
+    chains/sample=<name>/part-0.parquet             (transcript -> junction chain)
+
+A stage that only changes some tables writes just those and names the
+previous store as its base; tables missing from a store are read from
+the base. Readers can select samples, tables and columns, and files are
+memory-mapped.
+"""
+
+TABLES = ["classification", "junctions", "gtf", "expression", "chains"]
+
+MANIFEST = "manifest.json"
+
+def _partition(store, table, sample):
+    return os.path.join(store, table, f"sample={sample}", "part-0.parquet")
+
+def _encode(table, df):
+    """Make a table Parquet-friendly (junction chains mix str and int)."""
+    if table == "chains":
+        return pd.DataFrame({
+            "transcript_id": list(df),
+            "chr": [chain[0] for chain in df.values()],
+            "coords": [chain[1:] for chain in df.values()]
+        })
+    if table == "classification" and "junction_chain" in df.columns:
+        chains = df["junction_chain"]
+        df = df.drop(columns=["junction_chain"])
+        chains = [c if isinstance(c, (list, tuple)) else None for c in chains]
+        # labels: the strand and mono-exon mark of intron chains (see universal_id.split_chain)
+        n_labels = [None if c is None else sum(isinstance(x, str) for x in c[1:]) for c in chains]
+        df["junction_chain_chr"] = [None if c is None else c[0] for c in chains]
+        df["junction_chain_labels"] = [None if c is None else list(c[1:n + 1]) for c, n in zip(chains, n_labels)]
+        df["junction_chain_coords"] = [None if c is None else list(c[n + 1:]) for c, n in zip(chains, n_labels)]
+    return df
+
+def _decode(table, df):
+    if table == "chains":
+        return {
+            tid: [chrom] + np.asarray(coords).tolist()
+            for tid, chrom, coords in zip(df["transcript_id"], df["chr"], df["coords"])
+        }
+    if table == "classification" and "junction_chain_chr" in df.columns:
+        df = df.copy()
+        chroms = df.pop("junction_chain_chr")
+        labels = df.pop("junction_chain_labels") if "junction_chain_labels" in df.columns else [()] * len(df)
+        df["junction_chain"] = [
+            [chrom] + list(chain_labels) + np.asarray(coords).tolist() if chrom is not None else np.nan
+            for chrom, chain_labels, coords in zip(chroms, labels, df.pop("junction_chain_coords"))
+        ]
+    return df
+
+def create_store(store):
+    """Create an empty store directory (replacing an existing one)."""
+    if os.path.isdir(store):
+        shutil.rmtree(store)
+    os.makedirs(store)
+
+def write_samples(data, store, tables):
+    """Write `tables` of the samples of a SQANTI3 object to a store, without its manifest."""
+    for table in tables:
+        for sample in data["samples"]:
+            df = data["data"][sample].get(table)
+            if df is None:
+                continue
+            path = _partition(store, table, sample)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _encode(table, df).to_parquet(path)
+
+def write_manifest(store, samples, tables, base=None):
+    """Write the manifest of a store, completing it."""
+    manifest = {
+        "samples": samples,
+        "tables": tables,
+        "base": os.path.relpath(base, store) if base else None
+    }
+    with open(os.path.join(store, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+def write_store(data, store, tables=None, base=None):
+    """
+    Write a SQANTI3 object to a store directory (replacing an existing one).
+    Only `tables` are written (default: all present); others are read from `base`.
+    """
+    create_store(store)
+    samples = data["samples"]
+    if tables is None:
+        tables = [t for t in TABLES if any(data["data"][s].get(t) is not None for s in samples)]
+    write_samples(data, store, tables)
+    write_manifest(store, samples, tables, base)
+    print(f"Intermediate saved to {store}")
+
+def _read_manifest(store):
+    with open(os.path.join(store, MANIFEST)) as f:
+        return json.load(f)
+
+def store_samples(store):
+    """Samples of a store, in stored order."""
+    return _read_manifest(store)["samples"]
+
+def read_table(store, table, sample, columns=None):
+    """
+    Read one table of one sample, following base stores.
+    Returns None if the sample has no such table (e.g. no expression).
+    """
+    manifest = _read_manifest(store)
+    if table not in manifest["tables"]:
+        if manifest["base"] is None:
+            return None
+        return read_table(os.path.join(store, manifest["base"]), table, sample, columns)
+
+    path = _partition(store, table, sample)
+    if not os.path.exists(path):
+        return None
+    if columns is not None and table == "classification" and "junction_chain" in columns:
+        columns = [c for c in columns if c != "junction_chain"] + [
+            "junction_chain_chr", "junction_chain_labels", "junction_chain_coords"]
+    return _decode(table, pd.read_parquet(path, columns=columns, memory_map=True))
+
+def sample_bytes(store, sample, tables=None):
+    """On-disk size of the tables of one sample, following base stores."""
+    manifest = _read_manifest(store)
+    tables = TABLES if tables is None else tables
+    size = 0
+    for table in tables:
+        if table not in manifest["tables"]:
+            if manifest["base"] is not None:
+                size += sample_bytes(os.path.join(store, manifest["base"]), sample, [table])
+            continue
+        path = _partition(store, table, sample)
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+    return size
+
+def read_store(store, samples=None, tables=None, columns=None):
+    """
+    Read a store back into a {"n_samples", "samples", "data"} object.
+
+    Parameters
+    ----------
+    samples : list of str, optional
+        Samples to load (default: all, in stored order).
+    tables : list of str, optional
+        Tables to load (default: classification, junctions, gtf, expression
+        and chains when stored).
+    columns : dict, optional
+        table -> list of columns to load (default: all columns).
+    """
+    manifest = _read_manifest(store)
+    samples = manifest["samples"] if samples is None else samples
+    tables = TABLES if tables is None else tables
+    columns = columns or {}
+
+    data = {}
+    for sample in samples:
+        data[sample] = {}
+        for table in tables:
+            df = read_table(store, table, sample, columns.get(table))
+            if df is not None or table != "chains":
+                data[sample][table] = df
+
+    return {
+        "n_samples": len(samples),
+        "samples": list(samples),
+        "data": data
+    }
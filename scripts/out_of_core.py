@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+from collections import Counter
+from intermediate_store import TABLES, read_store, create_store, write_samples, write_manifest, sample_bytes
+from generalize_isoforms import build_catalog, take_rows, CATALOG_COLUMNS
+from ujc_catalog import merge_catalogs
+from universal_id import sample_chains, count_chains
+from ujc_fuzzy import merge_near_chains
+
+"""
+Out-of-core execution (sq_compare.py --out_of_core): the per-sample stages
+run on batches of samples that fit in a memory ceiling, and every stage
+spills its tables to an intermediate store (see intermediate_store.py)
+that the next stage reads back batch by batch. The UJC catalog is built by
+folding the catalogs of the batches with merge_catalogs, i.e. a streaming
+group-by on the chain key (first metadata, summed length for the mean,
+one matrix column per sample); TMM factors are computed by
+tmm_norm.normalize_samples one sample at a time.
+
+Batch sizes are estimated from the size of the input files or stored
+tables, so the ceiling is approximate; a sample larger than the ceiling
+gets a batch of its own.
+"""
+
+DEFAULT_MEMORY_LIMIT_GB = 8
+
+# Peak memory of a batch per byte of SQANTI3 text and of stored Parquet,
+# including the working copies a stage makes of its tables
+TEXT_EXPANSION = 3
+PARQUET_EXPANSION = 15
+
+def batches(samples, sizes, budget):
+    """Consecutive batches of samples whose sizes add up to at most budget."""
+    batch, used = [], 0
+    for sample, size in zip(samples, sizes):
+        if batch and used + size > budget:
+            yield batch
+            batch, used = [], 0
+        batch.append(sample)
+        used += size
+    if batch:
+        yield batch
+
+def _present_tables(data):
+    return {t for t in TABLES if any(data["data"][s].get(t) is not None for s in data["samples"])}
+
+def parse_to_store(rows, store, budget, load, func=None):
+    """
+    Load input rows (see parse_sq_inputs.read_input_rows) in batches with
+    load(rows) -> SQANTI3 object and write them to a new store.
+    func(batch, first) is called on every loaded batch.
+    Returns the samples in input order.
+    """
+    sizes = [TEXT_EXPANSION * sum(os.path.getsize(p) for p in row if isinstance(p, str) and os.path.exists(p))
+             for row in rows]
+    create_store(store)
+    samples, tables = [], set()
+    for i, batch in enumerate(batches(rows, sizes, budget)):
+        data = load(batch)
+        if func:
+            func(data, i == 0)
+        write_samples(data, store, _present_tables(data))
+        samples += data["samples"]
+        tables |= _present_tables(data)
+    write_manifest(store, samples, [t for t in TABLES if t in tables])
+    return samples
+
+def map_store(func, store, out_store, samples, budget, tables=None, base=None):
+    """
+    Apply func(batch, first) -> SQANTI3 object to batches of the samples of
+    a store, writing the results to a new store. Only `tables` of the
+    results are written (default: all present); others are read from `base`.
+    """
+    sizes = [PARQUET_EXPANSION * sample_bytes(store, s) for s in samples]
+    create_store(out_store)
+    written = set()
+    for i, batch in enumerate(batches(samples, sizes, budget)):
+        data = func(read_store(store, batch), i == 0)
+        batch_tables = _present_tables(data) if tables is None else tables
+        write_samples(data, out_store, batch_tables)
+        written |= set(batch_tables)
+    write_manifest(out_store, samples, [t for t in TABLES if t in written], base)
+
+def catalog_from_store(store, samples, budget, build=build_catalog, params=None):
+    """
+    UJC catalog of the samples of a store, built with build(batch) on
+    batches of samples and merged. Chains are in chain key order, as
+    build_catalog returns them.
+    """
+    tables = ["classification", "expression"]
+    sizes = [PARQUET_EXPANSION * sample_bytes(store, s, tables) for s in samples]
+    catalog = None
+    for batch in batches(samples, sizes, budget):
+        part = build(read_store(store, batch, tables, {"classification": CATALOG_COLUMNS}))
+        part["params"] = params
+        catalog = merge_catalogs(catalog, part) if catalog else part
+
+    chains = catalog["chains"].sort_index()
+    catalog["chains"] = chains
+    catalog["matrix"] = take_rows(catalog["matrix"], catalog["matrix"].index.get_indexer(chains.index))
+    return catalog
+
+def near_chain_representatives(store, samples, budget, chain_mode, tolerance):
+    """
+    ujc_fuzzy.merge_near_chains over the chains of all samples of a store,
+    read in batches, for standardize_isoforms_cross_sample(representatives=...).
+    """
+    tables = ["classification", "gtf", "chains"]
+    sizes = [PARQUET_EXPANSION * sample_bytes(store, s, tables) for s in samples]
+    counts = Counter()
+    for batch in batches(samples, sizes, budget):
+        data = read_store(store, batch, tables, {"classification": ["isoform", "strand"]})
+        counts.update(count_chains(sample_chains(data["data"][s], chain_mode) for s in batch))
+    return merge_near_chains(counts, tolerance)
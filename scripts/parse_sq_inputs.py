@@ -1,10 +1,94 @@
 #!/usr/bin/env python3
 import argparse
 import pandas as pd
-import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
+from intermediate_store import write_store
+from sample_cache import cached_table, evict, DEFAULT_CACHE_SIZE_GB
+from universal_id import cached_junction_chains, read_gtf
+from run_metrics import timed
 
-def parse_sqanti3_inputs(tsv_file):
+# Columns of *_classification.txt used by the later stages, with compact dtypes
+CLASSIFICATION_DTYPES = {
+    "isoform": "object",
+    "chrom": "category",
+    "strand": "category",
+    "length": "int32",
+    "exons": "int32",
+    "structural_category": "category",
+    "associated_gene": "object",
+    "associated_transcript": "object",
+    "subcategory": "category",
+}
+
+# Columns of *_junctions.txt kept alongside the isoform ID
+JUNCTIONS_DTYPES = {
+    "isoform": "object",
+    "chrom": "category",
+    "strand": "category",
+    "junction_number": "object",
+    "genomic_start_coord": "int32",
+    "genomic_end_coord": "int32",
+}
+
+def read_sqanti3_table(path, dtypes, full_tables=False, cache_dir=None, kind="table"):
+    """
+    Read a SQANTI3 classification or junctions table.
+    Only the columns in dtypes are loaded (with those dtypes) unless
+    full_tables is set, in which case every column is read as-is.
+    """
+    if full_tables:
+        return cached_table(cache_dir, path, kind, lambda p: pd.read_csv(p, sep="\t"), "full")
+    return cached_table(cache_dir, path, kind,
+                        lambda p: pd.read_csv(p, sep="\t", usecols=list(dtypes), dtype=dtypes),
+                        repr(dtypes))
+
+def get_sample_name(class_path):
+    """Sample name of a classification file (strip _classification.txt)."""
+    return Path(class_path).stem.replace("_classification", "")
+
+def load_sample(paths, full_tables=False, cache_dir=None):
+    """
+    Read the SQANTI3 outputs of one sample.
+
+    Parameters
+    ----------
+    paths : tuple
+        One row of the input TSV: classification, junctions, GTF and
+        (optional) expression paths.
+    full_tables : bool
+        Keep every classification/junctions column instead of the projected schema.
+    cache_dir : str, optional
+        Per-sample cache directory; unchanged inputs are loaded from it, and
+        the transcript -> junction chain mapping is added as "chains".
+    Returns
+    -------
+    tuple
+        (sample name, dict with classification/junctions/gtf/expression)
+    """
+    class_path = Path(paths[0])
+    sj_path = Path(paths[1])
+    gtf_path = Path(paths[2])
+    expr_path = Path(paths[3]) if len(paths) > 3 else None
+
+    sample_name = get_sample_name(class_path)
+
+    gtf = cached_table(cache_dir, gtf_path, "gtf", read_gtf, "exons")
+    sample = {
+        "classification": read_sqanti3_table(class_path, CLASSIFICATION_DTYPES, full_tables, cache_dir, "classification"),
+        "junctions": read_sqanti3_table(sj_path, JUNCTIONS_DTYPES, full_tables, cache_dir, "junctions"),
+        "gtf": gtf,
+        "expression": cached_table(cache_dir, expr_path, "expression",
+                                   lambda p: pd.read_csv(p, sep="\t", header=None, names=['isoform', 'count'], comment='#')) if expr_path else None
+    }
+    if cache_dir is not None:
+        sample["chains"] = cached_junction_chains(gtf_path, gtf, cache_dir)
+
+    return sample_name, sample
+
+def parse_sqanti3_inputs(tsv_file, workers=1, full_tables=False, exclude=None,
+                         cache_dir=None, cache_size_gb=DEFAULT_CACHE_SIZE_GB, sample_metrics=None):
     """
     Parse a TSV with paths to SQANTI3 outputs.
     
@@ -16,42 +100,67 @@ def parse_sqanti3_inputs(tsv_file):
         2) junctions.txt
         3) corrected.gtf
         4) (optional) expression levels
+    workers : int
+        Number of processes used to load samples concurrently (1 = sequential).
+    full_tables : bool
+        Load all classification/junctions columns with inferred dtypes
+        (default: only the columns used downstream, with compact dtypes).
+    exclude : collection of str, optional
+        Sample names to skip (e.g. samples already in the UJC catalog).
+    cache_dir : str, optional
+        Directory of the per-sample parse/chain cache (default: no cache).
+    cache_size_gb : float
+        Size limit of the cache; least recently used entries are evicted.
+    sample_metrics : dict, optional
+        Filled with the wall time, CPU time and peak RSS of loading each
+        sample (see run_metrics.timed).
     Returns
     -------
     dict
         Dictionary keyed by sample name. Each value is another dict with:
         - classification : DataFrame
         - junctions : DataFrame
-        - gtf : corrected.gtf
+        - gtf : exon records of corrected.gtf (transcript_id, chr, strand,
+          start, end)
         - expression : DataFrame or None
+        - chains : transcript -> junction chain (only with cache_dir)
     """
-    samples_info = {}
-
-    df_inputs = pd.read_csv(tsv_file, sep="\t", header=None)
-    n_samples = len(df_inputs)
-
-    for idx, row in df_inputs.iterrows():
-        class_path = Path(row[0])
-        sj_path = Path(row[1])
-        gtf_path = Path(row[2])
-        expr_path = Path(row[3]) if len(row) > 3 else None
-
-        # sample name extraction (strip _classification.txt)
-        sample_name = class_path.stem.replace("_classification", "")
-
-        samples_info[sample_name] = {
-            "classification": pd.read_csv(class_path, sep="\t"),
-            "junctions": pd.read_csv(sj_path, sep="\t"),
-            "gtf":pd.read_csv(gtf_path, sep="\t", header=None),
-            "expression": pd.read_csv(expr_path, sep="\t", header=None, names=['isoform', 'count'], comment='#') if expr_path else None
-        }
+    rows = read_input_rows(tsv_file, exclude)
+    samples_info = load_samples(rows, workers, full_tables, cache_dir, sample_metrics)
+    if cache_dir is not None:
+        evict(cache_dir, cache_size_gb * 1e9)
 
     return {
-        "n_samples": n_samples,
+        "n_samples": len(samples_info),
         "samples": list(samples_info.keys()),
         "data": samples_info
     }
 
+def read_input_rows(tsv_file, exclude=None):
+    """Rows (path tuples) of the input TSV, without the samples in exclude."""
+    df_inputs = pd.read_csv(tsv_file, sep="\t", header=None)
+    rows = list(df_inputs.itertuples(index=False, name=None))
+    if exclude:
+        rows = [row for row in rows if get_sample_name(row[0]) not in exclude]
+    return rows
+
+def load_samples(rows, workers=1, full_tables=False, cache_dir=None, sample_metrics=None):
+    """
+    Load the samples of input rows on `workers` processes.
+    Returns sample name -> tables, in input order.
+    """
+    loader = partial(timed, load_sample, full_tables=full_tables, cache_dir=cache_dir)
+    if workers > 1 and len(rows) > 1:
+        # map() yields results in submission order, so sample order is preserved
+        with ProcessPoolExecutor(max_workers=min(workers, len(rows))) as pool:
+            loaded = list(pool.map(loader, rows))
+    else:
+        loaded = [loader(row) for row in rows]
+
+    if sample_metrics is not None:
+        sample_metrics.update({name: m for (name, _), m in loaded})
+    return dict(result for result, _ in loaded)
+
 def main():
     parser = argparse.ArgumentParser(description="Parse SQANTI3 outputs from TSV file")
     parser.add_argument("--input_files", required=True,
@@ -60,19 +169,27 @@ def main():
         "--out", required=True,
         help="Path to the output folder"
     )
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of samples to load in parallel (default: 1)")
+    parser.add_argument("--full_tables", action="store_true",
+                        help="Keep all classification/junctions columns instead of only those used downstream")
+    parser.add_argument("--cache_dir", default=None,
+                        help="Directory for cached per-sample parse and junction chain results")
+    parser.add_argument("--cache_size", type=float, default=DEFAULT_CACHE_SIZE_GB,
+                        help=f"Cache size limit in GB (default: {DEFAULT_CACHE_SIZE_GB})")
     args = parser.parse_args()
 
-    result = parse_sqanti3_inputs(args.input_files)
+    result = parse_sqanti3_inputs(args.input_files, workers=args.workers, full_tables=args.full_tables,
+                                  cache_dir=args.cache_dir, cache_size_gb=args.cache_size)
 
     out_dir = Path(args.out)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    out_file = out_dir / "sqanti3_samples.pkl"
-    with open(out_file, "wb") as f:
-        pickle.dump(result, f)
+    out_store = out_dir / "sqanti3_samples"
+    write_store(result, out_store)
 
     print(f"Parsed {result['n_samples']} samples: {', '.join(result['samples'])}")
-    print(f"Results saved in {out_file}")
+    print(f"Results saved in {out_store}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+from run_metrics import stage as record_stage
+
+"""
+Resumable stage runner of sq_compare.py. Every stage declares the stages
+whose output it reads, the parameters it depends on and the files it
+writes; its fingerprint hashes its name and parameters with the
+fingerprints of those stages, so a change upstream invalidates every
+stage downstream. Finished stages are recorded in <out>/pipeline_state.json.
+
+A stage of the requested range (from_stage ... until_stage) runs when its
+fingerprint differs from the recorded one or its output files are missing;
+up-to-date stages are skipped. The output of a stage is loaded lazily, only
+when a stage that runs needs it: from memory if it ran in this process,
+else from its store when that was saved for the current fingerprint; else
+the stage runs again (an error if it is before from_stage).
+
+A stage is a dict:
+- name, title : stage name (see run_metrics.STAGES) and progress message
+- deps : names of the stages whose output it reads
+- params : JSON-serializable parameters the output depends on
+- run : run(inputs, record) -> output, with inputs = stage name -> output
+  and record the run_metrics stage record; None ends the run
+- outputs : files that must exist for the stage to be up to date
+- store : path its output is saved to (by run, or by save) or None
+- save : save(output, stored) writes the output to the store, given the
+  names of the stages whose store is up to date; only called with keep
+  or when a stage after until_stage reads it
+- load : load() -> output, from the store or the output files
+"""
+
+STATE_FILE = "pipeline_state.json"
+
+def fingerprint(*parts):
+    """Digest of JSON-serializable parts."""
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+def files_fingerprint(paths):
+    """Fingerprint of files by path, size and modification time."""
+    stats = []
+    for path in paths:
+        st = os.stat(path)
+        stats.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+    return fingerprint(stats)
+
+def load_state(out):
+    path = os.path.join(out, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(state, out):
+    with open(os.path.join(out, STATE_FILE), "w") as f:
+        json.dump(state, f, indent=1)
+
+def stage_range(stages, from_stage=None, until_stage=None):
+    """Names of the stages from from_stage to until_stage (default: first and last)."""
+    names = [s["name"] for s in stages]
+    for name in (from_stage, until_stage):
+        if name is not None and name not in names:
+            raise ValueError(f"Stage {name} is not part of this run ({', '.join(names)})")
+    start = names.index(from_stage) if from_stage else 0
+    end = names.index(until_stage) + 1 if until_stage else len(names)
+    if start >= end:
+        raise ValueError(f"--from_stage {from_stage} comes after --until_stage {until_stage}")
+    return names[start:end]
+
+def plan_run(stages, out, from_stage=None, until_stage=None):
+    """
+    Plan a run: the stages of the range that are not up to date, and the
+    stages before them whose output they need and cannot load.
+    Raises ValueError if the range is invalid or a stage before from_stage
+    has to run.
+    """
+    by_name = {s["name"]: s for s in stages}
+    names = [s["name"] for s in stages]
+    selected = stage_range(stages, from_stage, until_stage)
+
+    fingerprints = {}
+    for s in stages:
+        fingerprints[s["name"]] = fingerprint(s["name"], s.get("params"), [fingerprints[d] for d in s["deps"]])
+    state = load_state(out)
+
+    def up_to_date(name):
+        record = state.get(name, {})
+        return (record.get("fingerprint") == fingerprints[name]
+                and all(os.path.exists(p) for p in by_name[name].get("outputs", [])))
+
+    def loadable(name):
+        store = by_name[name].get("store")
+        return up_to_date(name) and (store is None or (state[name].get("stored") and os.path.exists(store)))
+
+    # stale stages of the range, then the unloadable stages they read from
+    to_run = {name for name in selected if not up_to_date(name)}
+    for name in reversed(names):
+        if name not in to_run:
+            continue
+        for dep in by_name[name]["deps"]:
+            if dep in to_run or loadable(dep):
+                continue
+            if dep not in selected:
+                raise ValueError(f"Stage {name} needs the output of stage {dep}, which is not stored for "
+                                 f"these inputs and parameters; run it first (--until_stage {dep})")
+            to_run.add(dep)
+
+    return {
+        "selected": selected,
+        "fingerprints": fingerprints,
+        "state": state,
+        "to_run": to_run,
+        "stored": {name for name in names if name not in to_run and loadable(name)}
+    }
+
+def run_pipeline(stages, out, metrics, plan, profiled=lambda name: None, keep=False):
+    """
+    Run the stages of a plan (see plan_run). Outputs are saved to their
+    store with keep, and those read by the stages after the range always.
+    Returns the names of the stages that ran.
+    """
+    by_name = {s["name"]: s for s in stages}
+    names = [s["name"] for s in stages]
+    selected, to_run, state = plan["selected"], plan["to_run"], plan["state"]
+    stored = set(plan["stored"])
+    later = names[names.index(selected[-1]) + 1:]
+    needed_later = {dep for name in later for dep in by_name[name]["deps"]}
+    if not to_run:
+        print(f"All stages are up to date in {out}")
+
+    outputs = {}
+    def output(name):
+        if name not in outputs:
+            outputs[name] = by_name[name]["load"]()
+        return outputs[name]
+
+    ran = []
+    for name in names:
+        spec = by_name[name]
+        if name not in to_run:
+            if name in selected:
+                print(f"Up to date: {spec['title']}")
+            continue
+        print(f"Running: {spec['title']}")
+        inputs = {dep: output(dep) for dep in spec["deps"]}
+        with record_stage(metrics, name, profiled(name)) as record:
+            result = spec["run"](inputs, record)
+        if result is None:
+            break
+        outputs[name] = result
+        ran.append(name)
+
+        # save the output if asked to, or if a later run continues from it
+        if spec.get("save") and (keep or name in needed_later):
+            spec["save"](result, stored)
+            stored.add(name)
+        elif spec.get("store") and not spec.get("save"):
+            stored.add(name)
+        else:
+            stored.discard(name)
+        state[name] = {"fingerprint": plan["fingerprints"][name], "stored": name in stored}
+        save_state(state, out)
+    return ran
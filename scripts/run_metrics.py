@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import cProfile
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+from datetime import datetime, timezone
+
+"""
+Run instrumentation for sq_compare.py: wall time, CPU time, peak RSS and
+row counts of every stage and sample, written to <out>/run_metrics.json.
+Stages can also be profiled with cProfile (<out>/profiles/<stage>.prof;
+worker processes are not profiled).
+
+Peak RSS is measured per stage and per sample: the high-water mark of the
+process (VmHWM) is reset when the stage or sample starts, and worker
+processes, which never outlive a stage, are polled for theirs. This needs
+Linux (/proc); elsewhere the peaks are reported as null.
+"""
+
+METRICS_FILE = "run_metrics.json"
+
+STAGES = ["parse", "collapse", "universal_id", "tmm", "matrix", "summary"]
+
+ROW_TABLES = ["classification", "junctions", "gtf", "expression"]
+
+# Seconds between two polls of the worker processes' peak RSS
+CHILD_POLL_S = 0.05
+
+# Peak RSS (kB) of this process before its last reset, so that a nested
+# measurement (a sample timed within a stage) does not hide the stage's peak
+_held_peak_kb = 0
+
+def _status_kb(pid, field):
+    """A kB field (VmHWM, VmRSS) of /proc/<pid>/status, or None."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss(nested=False):
+    """
+    Reset the peak RSS of this process (Linux: /proc/self/clear_refs).
+    Nested resets keep the peak so far for the enclosing measurement.
+    Returns False where this is not supported.
+    """
+    global _held_peak_kb
+    peak = _status_kb("self", "VmHWM")
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    _held_peak_kb = max(_held_peak_kb, peak or 0) if nested else 0
+    return True
+
+def _peak_rss_mb(held=False):
+    """Peak RSS of this process since the last reset (or the enclosing one, with held), in MB."""
+    peak = _status_kb("self", "VmHWM") or 0
+    return round(max(peak, _held_peak_kb if held else 0) / 2 ** 10, 1)
+
+def _descendants(pid):
+    """PIDs of the processes started by a process and by those (none once it has exited)."""
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    pids = []
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                pids += [int(p) for p in f.read().split()]
+        except OSError:
+            pass
+    return pids + [d for p in pids for d in _descendants(p)]
+
+def _watch_children(stop, peak):
+    """Keep the largest peak RSS (kB) of the worker processes in peak[0] until stop is set."""
+    while True:
+        for pid in _descendants(os.getpid()):
+            peak[0] = max(peak[0], _status_kb(pid, "VmHWM") or 0)
+        if stop.wait(CHILD_POLL_S):
+            return
+
+def _cpu_s():
+    """CPU time of this process and of its finished worker processes."""
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+def new_run(argv):
+    """Metrics of a new run."""
+    return {
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "argv": list(argv),
+        "stages": []
+    }
+
+@contextlib.contextmanager
+def stage(metrics, name, profile_dir=None):
+    """
+    Record a stage of the run. The yielded dict is the stage record; the
+    caller adds rows_in, rows_out and per-sample entries ("samples") to it.
+    peak_rss_mb is the peak of the main process during the stage,
+    children_peak_rss_mb that of the largest worker process it started.
+    """
+    record = {"stage": name}
+    profiler = cProfile.Profile() if profile_dir else None
+    per_stage = _reset_peak_rss()
+    children, stop = [0], threading.Event()
+    watcher = threading.Thread(target=_watch_children, args=(stop, children), daemon=True)
+    if per_stage:
+        watcher.start()
+    wall, cpu = time.perf_counter(), _cpu_s()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            record["profile"] = os.path.join(profile_dir, f"{name}.prof")
+            profiler.dump_stats(record["profile"])
+        record["wall_s"] = round(time.perf_counter() - wall, 3)
+        record["cpu_s"] = round(_cpu_s() - cpu, 3)
+        if per_stage:
+            stop.set()
+            watcher.join()
+        record["peak_rss_mb"] = _peak_rss_mb(held=True) if per_stage else None
+        record["children_peak_rss_mb"] = round(children[0] / 2 ** 10, 1) if per_stage else None
+        metrics["stages"].append(record)
+
+def timed(func, *args, **kwargs):
+    """
+    Call func in a worker and return (result, metrics) with its wall time,
+    CPU time and the peak RSS of the process during the call.
+    """
+    measured = _reset_peak_rss(nested=True)
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    return result, {
+        "wall_s": round(time.perf_counter() - wall, 3),
+        "cpu_s": round(time.process_time() - cpu, 3),
+        "peak_rss_mb": _peak_rss_mb() if measured else None
+    }
+
+def table_rows(data):
+    """Row counts of the tables of every sample of a SQANTI3 object."""
+    return {
+        sample: {table: len(tables[table]) for table in ROW_TABLES if tables.get(table) is not None}
+        for sample, tables in data["data"].items()
+    }
+
+def total_rows(data, table="classification"):
+    """Total rows of one table over all samples."""
+    return int(sum(len(t[table]) for t in data["data"].values() if t.get(table) is not None))
+
+def add_rows(record, key, data, table="classification"):
+    """Add the total rows of one table of a (batch of a) SQANTI3 object to a stage record."""
+    record[key] = record.get(key, 0) + total_rows(data, table)
+
+def add_sample_rows(record, data, key="rows_out"):
+    """Add per-sample row counts of a SQANTI3 object to a stage record."""
+    samples = record.setdefault("samples", {})
+    for sample, rows in table_rows(data).items():
+        samples.setdefault(sample, {})[key] = rows
+
+def write_metrics(metrics, out):
+    """Write the run metrics to <out>/run_metrics.json."""
+    metrics["total_wall_s"] = round(sum(s["wall_s"] for s in metrics["stages"]), 3)
+    path = os.path.join(out, METRICS_FILE)
+    with open(path, "w") as f:
+        json.dump(metrics, f, indent=1)
+    print(f"Run metrics saved to {path}")
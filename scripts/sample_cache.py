@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import uuid
+import pandas as pd
+
+"""
+Content-addressed cache for per-sample parse and junction chain results.
+
+Entries are Parquet files named after a hash of (kind, parameters, content
+digest of the input file). Content digests are memoized per
+(path, size, mtime), so unchanged inputs are not re-hashed. The cache is
+kept under a size limit by evicting the least recently used entries.
+
+<cache_dir>/
+    digests/<hash of path, size, mtime>   content digest of an input file
+    entries/<key>.parquet                 cached table
+"""
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE_GB = 50
+
+def _atomic_write(path, write):
+    """Write via a temporary file so concurrent runs never see partial entries."""
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def file_digest(path, cache_dir):
+    """BLAKE2 digest of a file's content, memoized by path, size and mtime."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = hashlib.blake2b(f"{path}\t{st.st_size}\t{st.st_mtime_ns}".encode(), digest_size=16).hexdigest()
+    memo = os.path.join(cache_dir, "digests", stat_key)
+    if os.path.exists(memo):
+        with open(memo) as f:
+            return f.read().strip()
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            h.update(block)
+    digest = h.hexdigest()
+
+    os.makedirs(os.path.dirname(memo), exist_ok=True)
+    def write(tmp):
+        with open(tmp, "w") as f:
+            f.write(digest)
+    _atomic_write(memo, write)
+    return digest
+
+def entry_path(cache_dir, path, kind, params=""):
+    """Cache entry for `kind` (e.g. "classification", "chains") of an input file."""
+    key = f"{CACHE_VERSION}\t{kind}\t{params}\t{file_digest(path, cache_dir)}"
+    name = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, "entries", f"{name}.parquet")
+
+def cached_table(cache_dir, path, kind, reader, params=""):
+    """
+    Return reader(path), loading it from the cache when the input file is
+    unchanged and storing it otherwise. With cache_dir=None this is reader(path).
+    """
+    if cache_dir is None:
+        return reader(path)
+
+    entry = entry_path(cache_dir, path, kind, params)
+    if os.path.exists(entry):
+        os.utime(entry)  # mark as recently used
+        return pd.read_parquet(entry)
+
+    df = reader(path)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    _atomic_write(entry, lambda tmp: df.to_parquet(tmp))
+    return df
+
+def evict(cache_dir, max_bytes):
+    """Delete least recently used entries until the cache fits in max_bytes."""
+    entries_dir = os.path.join(cache_dir, "entries")
+    if not os.path.isdir(entries_dir):
+        return
+    entries = []
+    for name in os.listdir(entries_dir):
+        if not name.endswith(".parquet"):
+            continue
+        path = os.path.join(entries_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:  # evicted by a concurrent run
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
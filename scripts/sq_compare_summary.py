@@ -7,9 +7,13 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.patches import Rectangle
 from matplotlib import rcParams
+import scipy.sparse as sp
+from scipy.cluster.hierarchy import linkage, leaves_list
+from scipy.spatial.distance import cdist
 import seaborn as sns
-from upsetplot import UpSet, from_memberships
+from upsetplot import UpSet
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import warnings
 #import logging
@@ -38,6 +42,15 @@ cat_palette = {
     "Fusion":"#FFB90F",  "Intergenic":"#E9967A", "Genic\nIntron":"#41B6C4"
 }
 
+PLOT_FORMATS = ["jpeg", "png", "pdf", "svg"]
+
+# Expression clustermap: most variable UJCs shown, rows densified at a time
+DEFAULT_HEATMAP_TOP = 1000
+HEATMAP_CHUNK_ROWS = 100_000
+
+# Enough to show every intersection of up to 6 samples
+DEFAULT_TOP_INTERSECTIONS = 64
+
 grad_palette = ["#15918A", "#F58A53", "#FDC659"]  # green → orange → yellow
 
 my_theme = {
@@ -60,128 +73,204 @@ my_theme = {
 }
 rcParams.update(my_theme)
 
-parser = argparse.ArgumentParser(description="Summarize isoform metadata and expression matrices")
-parser.add_argument(
-    "--out", required=True,
-    help="Output folder"
-)
-args = parser.parse_args()
-
-isoform_info = pd.read_csv(f"{args.out}/summarized/isoform_info.tsv", sep="\t")
-matrix = pd.read_csv(f"{args.out}/summarized/isoform_matrix.tsv", sep="\t")
-
-samples = matrix.columns[1:].tolist() 
-n_samples = len(samples)
-
-isoform_info["category"] = isoform_info["category"].replace(dict(zip(categories_raw, categories)))
-
-# Summary statistics
-
-summary_stats = {}
-
-for sample in samples:
-    present_jc = matrix.loc[matrix[sample] > 0, "unique_jc"]
-    per_sample = isoform_info[isoform_info["unique_jc"].isin(present_jc)].copy()
-    # total isoforms
-    summary_stats.setdefault("isoforms_per_sample", pd.Series(dtype=int))
-    summary_stats["isoforms_per_sample"].at[sample] = per_sample.shape[0]
-    # isoforms per category
-    cat_counts = per_sample["category"].value_counts().astype(int)
-    summary_stats.setdefault("isoforms_per_category", pd.DataFrame(0, index=samples, columns=categories))
-    summary_stats["isoforms_per_category"].loc[sample] = cat_counts
-    # mono vs multi
-    mm_counts = per_sample["exons_n"].apply(lambda x: "Monoexon" if x==1 else "Multiexon").value_counts()
-    summary_stats.setdefault("mono_vs_multi", pd.DataFrame(0, index=samples, columns=["Monoexon","Multiexon"]))
-    summary_stats["mono_vs_multi"].loc[sample] = mm_counts
-
-# Prepare summary tables for PDF
-summary_rows = []
-
-# Table 1: Isoforms per Sample
-isoforms_per_sample = summary_stats["isoforms_per_sample"]
-isoforms_per_sample_df = pd.DataFrame({
-    "Sample": isoforms_per_sample.index,
-    "Isoform count": isoforms_per_sample.values
-})
-
-# Table 2: Isoforms per Category
-cat_table = summary_stats["isoforms_per_category"].copy()
-cat_table.index.name = "Sample"
-cat_table.reset_index(inplace=True)
-
-# Table 3: Mono- VS Multiexon
-mono_multi_table = summary_stats["mono_vs_multi"].copy()
-mono_multi_table.index.name = "Sample"
-mono_multi_table.reset_index(inplace=True)
-
-# Write summary tables to PDF
-report_path = f"{args.out}/summarized/sq_compare_stats.pdf"
-with PdfPages(report_path) as pdf:
-    # Front page
-    fig, ax = plt.subplots(figsize=(8.5, 11))
-    ax.axis('off')
-    ax.text(0.5, 0.7, "SQcompare Summary", fontsize=28, fontweight='bold', ha='center')
-    ax.text(0.5, 0.6, f"Samples: {n_samples}", fontsize=18, ha='center')
-    ax.text(0.5, 0.55, f"Total UJCs: {isoform_info.shape[0]}", fontsize=16, ha='center')
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
-    # Summary page
-    fig, ax = plt.subplots(figsize=(8.5, 11))
-    ax.axis('off')
-    ax.set_title("Table 1. UJSs per Sample", fontsize=16, pad=40)
-    plt.subplots_adjust(top=0.85) 
-    table1 = ax.table(
-        cellText=isoforms_per_sample_df.values,
-        colLabels=isoforms_per_sample_df.columns,
-        loc='center'
-    )
-    table1.auto_set_font_size(False)
-    table1.set_fontsize(12)
-    table1.scale(1.2, 1.2)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
-    #Table2
-    fig, ax = plt.subplots(figsize=(8.5, 11))
-    ax.axis('off')
-    ax.set_title("Table 2. UJCs per Category", fontsize=16, pad=40)
-    plt.subplots_adjust(top=0.85) 
-    table2 = ax.table(
-        cellText=cat_table.values,
-        colLabels=cat_table.columns,
-        loc='center',
-        cellLoc='right'
-    )
-    table2.auto_set_font_size(False)
-    table2.set_fontsize(8)
-    table2.scale(1.2, 1.2)
-    for (row, col), cell in table2.get_celld().items():
-        if row == 0:  # header row
-            cell.set_height(cell.get_height() * 1.8) 
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
-    #Table3
-    fig, ax = plt.subplots(figsize=(8.5, 11))
-    ax.axis('off')
-    ax.set_title("Table 3. Mono- VS Multiexon", fontsize=16, pad=40)
-    plt.subplots_adjust(top=0.85) 
-    table3 = ax.table(
-        cellText=mono_multi_table.values,
-        colLabels=mono_multi_table.columns,
-        loc='center',
-        cellLoc='right'
+def _sample_values(matrix, samples):
+    """Sample columns of the isoform matrix (dense or sparse) as a CSR matrix."""
+    values = matrix[samples]
+    if all(isinstance(t, pd.SparseDtype) for t in values.dtypes):
+        return values.sparse.to_coo().tocsr().astype(float)
+    return sp.csr_matrix(values.to_numpy(dtype=float))
+
+def _welford_rows(block):
+    """Row means and sums of squared deviations of a dense block, one column at a time (Welford)."""
+    mean = np.zeros(block.shape[0])
+    m2 = np.zeros(block.shape[0])
+    for j in range(block.shape[1]):
+        x = block[:, j]
+        delta = x - mean
+        mean += delta / (j + 1)
+        m2 += delta * (x - mean)
+    return mean, m2
+
+def top_variable_rows(values, k, chunk_rows=HEATMAP_CHUNK_ROWS):
+    """
+    Positions of the k rows of a CSR matrix with the largest sample variance
+    (ddof=1), largest first (ties by position). Rows are densified chunk_rows
+    at a time and only the k best rows are kept between chunks.
+    """
+    n_rows, n_samples = values.shape
+    best_rows = np.empty(0, dtype=np.int64)
+    best_var = np.empty(0)
+    for start in range(0, n_rows, chunk_rows):
+        block = values[start:start + chunk_rows].toarray()
+        _, m2 = _welford_rows(block)
+        rows = np.concatenate([best_rows, np.arange(start, start + len(block))])
+        var = np.concatenate([best_var, m2 / (n_samples - 1)])
+        keep = np.lexsort((rows, -var))[:k]
+        best_rows, best_var = rows[keep], var[keep]
+    return best_rows
+
+def _cluster_order(data, cluster_rows, seed=0):
+    """
+    Row order from hierarchical clustering of a random subsample of
+    cluster_rows rows; every other row is placed next to its nearest
+    clustered row. Linkage cost is bounded by cluster_rows.
+    """
+    rng = np.random.default_rng(seed)
+    sampled = np.sort(rng.choice(len(data), cluster_rows, replace=False))
+    # seaborn's clustermap defaults: average linkage, euclidean distance
+    leaves = sampled
+    if cluster_rows > 1:   # a single row has no linkage
+        leaves = sampled[leaves_list(linkage(data[sampled], method="average", metric="euclidean"))]
+    nearest = np.concatenate([
+        cdist(data[start:start + 10_000], data[leaves]).argmin(axis=1)
+        for start in range(0, len(data), 10_000)
+    ])
+    return np.lexsort((np.arange(len(data)), nearest))
+
+def _one_hot(codes, n_classes):
+    """Sparse indicator matrix (rows x classes) of class codes; code -1 is left out."""
+    rows = np.flatnonzero(codes >= 0)
+    return sp.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, codes[rows])),
+                         shape=(len(codes), n_classes))
+
+def summary_statistics(isoform_info, matrix, samples):
+    """
+    Per-sample summary tables, computed in one pass as products of the
+    UJC x sample presence matrix with one-hot category and exon-class
+    indicators. Returns a dict with isoforms_per_sample, isoforms_per_category,
+    mono_vs_multi and lengths (sample -> UJC lengths, for the KDE plot).
+    """
+    # presence, with rows aligned to isoform_info (matrix rows are mapped
+    # to isoform_info rows once, by chain)
+    info_row = pd.Index(isoform_info["unique_jc"]).get_indexer(matrix["unique_jc"])
+    values = _sample_values(matrix, samples).tocoo()
+    keep = (values.data > 0) & (info_row[values.row] >= 0)
+    presence = sp.csc_matrix(
+        (np.ones(keep.sum(), dtype=np.int64), (info_row[values.row[keep]], values.col[keep])),
+        shape=(len(isoform_info), len(samples))
     )
-    table3.auto_set_font_size(False)
-    table3.set_fontsize(12)
-    table3.scale(1.2, 1.2)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+    presence.data[:] = 1   # a UJC is counted once per sample
+    presence.sort_indices()
+
+    category_codes = pd.Categorical(isoform_info["category"], categories=categories).codes
+    exon_class = np.where(isoform_info["exons_n"].values == 1, 0, 1)   # monoexon, multiexon
+    per_category = (presence.T @ _one_hot(category_codes, len(categories))).toarray()
+    mono_multi = (presence.T @ _one_hot(exon_class, 2)).toarray()
+
+    lengths = isoform_info["length"].values
+    return {
+        "isoforms_per_sample": pd.Series(np.diff(presence.indptr).astype(np.int64), index=samples),
+        "isoforms_per_category": pd.DataFrame(per_category, index=samples, columns=categories),
+        "mono_vs_multi": pd.DataFrame(mono_multi, index=samples, columns=["Monoexon", "Multiexon"]),
+        "lengths": {
+            sample: lengths[presence.indices[presence.indptr[j]:presence.indptr[j + 1]]]
+            for j, sample in enumerate(samples)
+        },
+        "presence": presence
+    }
 
-print(f"Summary statistics saved to {report_path}")
+def intersection_counts(presence, samples, top=None):
+    """
+    Number of UJCs in each sample intersection (the exact set of samples a
+    UJC is present in), largest first. Presence rows are bit-packed into
+    signatures of 64-bit words, which are counted in one pass.
+    Returns a DataFrame with one boolean column per sample, degree and ujcs;
+    with `top`, only the `top` largest intersections.
+    """
+    n_words = max(1, -(-len(samples) // 64))
+    coo = presence.tocoo()
+    signatures = np.zeros((presence.shape[0], n_words), dtype=np.uint64)
+    np.bitwise_or.at(signatures, (coo.row, coo.col // 64),
+                     np.left_shift(np.uint64(1), (coo.col % 64).astype(np.uint64)))
+    unique, counts = np.unique(signatures, axis=0, return_counts=True)
 
-# Generate plots
+    order = np.argsort(-counts, kind="stable")
+    if top:
+        order = order[:top]
+    cols = np.arange(len(samples))
+    members = (unique[order][:, cols // 64] >> (cols % 64).astype(np.uint64)) & np.uint64(1)
 
-if n_samples < 7:
-    cat_counts_df = summary_stats["isoforms_per_category"].copy()
+    intersections = pd.DataFrame(members.astype(bool), columns=samples)
+    intersections["degree"] = intersections[samples].sum(axis=1)
+    intersections["ujcs"] = counts[order]
+    return intersections
+
+def write_intersections(intersections, samples, path):
+    """Intersections as TSV: samples (comma-separated), degree, ujcs."""
+    members = intersections[samples].to_numpy()
+    names = np.array(samples, dtype=object)
+    pd.DataFrame({
+        "samples": [",".join(names[row]) for row in members],
+        "degree": intersections["degree"].values,
+        "ujcs": intersections["ujcs"].values
+    }).to_csv(path, sep="\t", index=False)
+
+# --- Render tasks: each writes one file and only takes small, picklable inputs ---
+
+def _write_stats_pdf(report_path, n_samples, n_ujcs, isoforms_per_sample_df, cat_table, mono_multi_table):
+    """Summary tables as a PDF report."""
+    with PdfPages(report_path) as pdf:
+        # Front page
+        fig, ax = plt.subplots(figsize=(8.5, 11))
+        ax.axis('off')
+        ax.text(0.5, 0.7, "SQcompare Summary", fontsize=28, fontweight='bold', ha='center')
+        ax.text(0.5, 0.6, f"Samples: {n_samples}", fontsize=18, ha='center')
+        ax.text(0.5, 0.55, f"Total UJCs: {n_ujcs}", fontsize=16, ha='center')
+        pdf.savefig(fig, bbox_inches='tight')
+        plt.close(fig)
+        # Summary page
+        fig, ax = plt.subplots(figsize=(8.5, 11))
+        ax.axis('off')
+        ax.set_title("Table 1. UJSs per Sample", fontsize=16, pad=40)
+        plt.subplots_adjust(top=0.85) 
+        table1 = ax.table(
+            cellText=isoforms_per_sample_df.values,
+            colLabels=isoforms_per_sample_df.columns,
+            loc='center'
+        )
+        table1.auto_set_font_size(False)
+        table1.set_fontsize(12)
+        table1.scale(1.2, 1.2)
+        pdf.savefig(fig, bbox_inches='tight')
+        plt.close(fig)
+        #Table2
+        fig, ax = plt.subplots(figsize=(8.5, 11))
+        ax.axis('off')
+        ax.set_title("Table 2. UJCs per Category", fontsize=16, pad=40)
+        plt.subplots_adjust(top=0.85) 
+        table2 = ax.table(
+            cellText=cat_table.values,
+            colLabels=cat_table.columns,
+            loc='center',
+            cellLoc='right'
+        )
+        table2.auto_set_font_size(False)
+        table2.set_fontsize(8)
+        table2.scale(1.2, 1.2)
+        for (row, col), cell in table2.get_celld().items():
+            if row == 0:  # header row
+                cell.set_height(cell.get_height() * 1.8) 
+        pdf.savefig(fig, bbox_inches='tight')
+        plt.close(fig)
+        #Table3
+        fig, ax = plt.subplots(figsize=(8.5, 11))
+        ax.axis('off')
+        ax.set_title("Table 3. Mono- VS Multiexon", fontsize=16, pad=40)
+        plt.subplots_adjust(top=0.85) 
+        table3 = ax.table(
+            cellText=mono_multi_table.values,
+            colLabels=mono_multi_table.columns,
+            loc='center',
+            cellLoc='right'
+        )
+        table3.auto_set_font_size(False)
+        table3.set_fontsize(12)
+        table3.scale(1.2, 1.2)
+        pdf.savefig(fig, bbox_inches='tight')
+        plt.close(fig)
+    return f"Summary statistics saved to {report_path}"
+
+def _plot_category_counts(path, plot_format, dpi, cat_counts_df):
     fig, ax = plt.subplots(figsize=(8, 6))
     cat_counts_df.plot(
         kind="bar",
@@ -193,16 +282,15 @@ if n_samples < 7:
     ax.set_xlabel("Sample")
     ax.set_title("Categories per Sample")
     ax.legend(title="Category", bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0.)
-    # Save the figure as a JPEG file
-    fig.savefig(f"{args.out}/summarized/ujc_per_category.jpeg", format="jpeg", dpi=300, bbox_inches='tight')
+    fig.savefig(path, format=plot_format, dpi=dpi, bbox_inches='tight')
     plt.close(fig)
-print('UJC per category plot done')
-if n_samples < 7:
+    return 'UJC per category plot done'
+
+def _plot_category_composition(path, plot_format, dpi, cat_counts_df):
     # Stacked bar plot (proportions)
-    cat_counts_df = summary_stats["isoforms_per_category"].copy()
     cat_props_df = cat_counts_df.div(cat_counts_df.sum(axis=1), axis=0)
     fig, ax = plt.subplots(figsize=(8, 6))
-    bottom = np.zeros(n_samples)
+    bottom = np.zeros(len(cat_props_df))
     for cat in categories:
         ax.bar(
             cat_props_df.index,
@@ -224,18 +312,16 @@ if n_samples < 7:
         borderaxespad=0.
     )
     fig.tight_layout(rect=[0, 0, 0.8, 1])
-    fig.savefig(f"{args.out}/summarized/ujc_category_composition.jpeg", format="jpeg", dpi=300, bbox_inches='tight')
+    fig.savefig(path, format=plot_format, dpi=dpi, bbox_inches='tight')
     plt.close(fig)
-print('UJC category composition plot done')
-
-# average length distribution
-fig, ax = plt.subplots(figsize=(8,6))
-for sample in samples:
-    subset = isoform_info[isoform_info["unique_jc"].isin(
-        matrix.loc[matrix[sample]>0, "unique_jc"]
-    )]
-    if not subset["length"].empty:
-        sns.kdeplot(subset["length"], label=sample, ax=ax)
+    return 'UJC category composition plot done'
+
+def _plot_length_distribution(path, plot_format, dpi, lengths):
+    # average length distribution
+    fig, ax = plt.subplots(figsize=(8,6))
+    for sample, sample_lengths in lengths.items():
+        if len(sample_lengths):
+            sns.kdeplot(sample_lengths, label=sample, ax=ax)
     ax.set_title("UJC Length Distributions")
     ax.set_xlabel("Length")
     ax.set_ylabel("Density")
@@ -246,69 +332,217 @@ for sample in samples:
         borderaxespad=0.
     )
     fig.tight_layout(rect=[0, 0, 0.8, 1])
-    fig.savefig(f"{args.out}/summarized/ujc_length_distribution.jpeg", format="jpeg", dpi=300, bbox_inches='tight')
+    fig.savefig(path, format=plot_format, dpi=dpi, bbox_inches='tight')
     plt.close(fig)
-print('UJC length distribution plot done')
+    return 'UJC length distribution plot done'
 
-# heatmap (if expression values provided)
-if (matrix[samples].values > 1).any():
-    variances = matrix[samples].var(axis=1)
-    top = matrix.loc[variances.nlargest(1000).index] 
-    data = top.set_index("unique_jc")[samples]
+def _plot_clustermap(path, plot_format, dpi, data, cluster_rows):
     # Log-transform the expression values (add 1 to avoid log(0))
     data_log = np.log1p(data)
+    # a single row cannot be clustered
+    row_cluster = len(data_log) > 1
+    if row_cluster and cluster_rows and len(data_log) > cluster_rows:
+        # cluster a subsample and order the other rows around it
+        data_log = data_log.iloc[_cluster_order(data_log.to_numpy(), cluster_rows)]
+        row_cluster = False
     # Use seaborn clustermap for hierarchical clustering
     cg = sns.clustermap(
         data_log,
         cmap="YlGnBu",
         figsize=(10, 6),
         cbar_kws={"label": "Log(TMM+1)"},
+        row_cluster=row_cluster,
         yticklabels=False,  # Hide isoform IDs
         xticklabels=True    # Show sample names
     )
     # Titles and labels
-    cg.figure.suptitle("Log-transformed Expression Clustermap (TMM) - Top 1000 Variable UJCs", y=1.05, fontsize=16)
+    cg.figure.suptitle(f"Log-transformed Expression Clustermap (TMM) - Top {len(data)} Variable UJCs", y=1.05, fontsize=16)
     cg.ax_heatmap.set_xlabel("Samples")
     cg.ax_heatmap.set_ylabel("Isoforms")
     # Save figure
-    cg.savefig(
-        f"{args.out}/summarized/expression_clustermap.jpeg",
-        dpi=300,
-        bbox_inches="tight"
-    )
+    cg.savefig(path, format=plot_format, dpi=dpi, bbox_inches="tight")
     plt.close(cg.fig)  # close the figure to free memory
-print('Expression clustermap done')
-
-# Plot a standard UpSet plot
-if n_samples < 7:
-    memberships = []
-    for jc, row in matrix.set_index("unique_jc")[samples].iterrows():
-        present = [s for s in samples if row[s] > 0]
-        memberships.append(tuple(present))
-    data = from_memberships(memberships)
-    fig = plt.figure(figsize=(8,6))
-    upset = UpSet(data, subset_size='count', show_counts=True)
+    return 'Expression clustermap done'
+
+def _plot_upset(path, plot_format, dpi, intersections, samples, truncated):
+    # UpSet plot from precomputed intersection sizes
+    data = pd.Series(intersections["ujcs"].values,
+                     index=pd.MultiIndex.from_frame(intersections[samples]))
+    figsize = (max(8, 0.2 * len(intersections) + 2), max(6, 0.25 * len(samples) + 4.5))
+    fig = plt.figure(figsize=figsize)
+    upset = UpSet(data, subset_size='sum', show_counts=True)
     upset.plot(fig=fig)
+    if truncated:
+        # set sizes only count the UJCs of the intersections shown
+        fig.suptitle(f"Top {len(intersections)} intersections")
     fig.tight_layout()
-    fig.savefig(f"{args.out}/summarized/upset_standard.jpeg", format="jpeg", dpi=300, bbox_inches='tight')
+    fig.savefig(path, format=plot_format, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return 'UpSet plot done'
+
+def _plot_mono_multi(path, plot_format, dpi, mono_multi_table):
+    # Plot proportions of mono- and multi-exons per sample
+    mono_multi_props = mono_multi_table.iloc[:, 1:].div(mono_multi_table.iloc[:, 1:].sum(axis=1), axis=0)
+    mono_multi_props.index = mono_multi_table["Sample"] if "Sample" in mono_multi_table.columns else mono_multi_table.index
+    fig, ax = plt.subplots(figsize=(8, 6))
+    mono_multi_props.plot(
+        kind="bar",
+        stacked=True,
+        ax=ax,
+        color=["#FDC659", "#3B125A"]
+    )
+    ax.set_ylabel("Proportion of Isoforms")
+    ax.set_xlabel("Sample")
+    ax.set_title("Proportion of Monoexon vs Multiexon Isoforms per Sample")
+    ax.legend(title="Exon Type", bbox_to_anchor=(1.05, 1), loc='upper left')
+    fig.tight_layout(rect=[0, 0, 0.8, 1])
+    fig.savefig(path, format=plot_format, dpi=dpi, bbox_inches='tight')
     plt.close(fig)
-print('UpSet plot done')
-
-# Plot proportions of mono- and multi-exons per sample
-mono_multi_props = mono_multi_table.iloc[:, 1:].div(mono_multi_table.iloc[:, 1:].sum(axis=1), axis=0)
-mono_multi_props.index = mono_multi_table["Sample"] if "Sample" in mono_multi_table.columns else mono_multi_table.index
-fig, ax = plt.subplots(figsize=(8, 6))
-mono_multi_props.plot(
-    kind="bar",
-    stacked=True,
-    ax=ax,
-    color=["#FDC659", "#3B125A"]
-)
-ax.set_ylabel("Proportion of Isoforms")
-ax.set_xlabel("Sample")
-ax.set_title("Proportion of Monoexon vs Multiexon Isoforms per Sample")
-ax.legend(title="Exon Type", bbox_to_anchor=(1.05, 1), loc='upper left')
-fig.tight_layout(rect=[0, 0, 0.8, 1])
-fig.savefig(f"{args.out}/summarized/mono_multi_proportion.jpeg", format="jpeg", dpi=300, bbox_inches='tight')
-plt.close(fig)
-print(f"Plots saved to {args.out}/summarized/")
\ No newline at end of file
+    return 'Mono/multiexon proportion plot done'
+
+def _run_task(task):
+    func, args = task
+    return func(*args)
+
+def render(tasks, workers=1):
+    """Run render tasks (func, args), on a process pool when workers > 1."""
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            futures = [pool.submit(_run_task, task) for task in tasks]
+            for future in as_completed(futures):
+                print(future.result())
+    else:
+        for task in tasks:
+            print(_run_task(task))
+
+def summarize(out, isoform_info=None, matrix=None, plot_format="jpeg", dpi=300, workers=1,
+              top_intersections=DEFAULT_TOP_INTERSECTIONS, heatmap_top=DEFAULT_HEATMAP_TOP,
+              heatmap_cluster_rows=0):
+    """
+    Write summary tables and plots to <out>/summarized.
+    isoform_info and matrix are read from the summarized TSVs unless passed in.
+    Figures are rendered as independent tasks, on `workers` processes.
+    intersections.tsv and the UpSet plot hold the `top_intersections`
+    largest sample intersections (0: all). The expression clustermap shows
+    the `heatmap_top` most variable UJCs; with heatmap_cluster_rows, rows are
+    ordered by clustering a subsample of that many rows.
+    """
+    if isoform_info is None:
+        isoform_info = pd.read_csv(f"{out}/summarized/isoform_info.tsv", sep="\t")
+    else:
+        # match the TSV round trip: unique_jc is keyed by its string form
+        # and category holds plain strings
+        isoform_info = isoform_info.assign(
+            unique_jc=isoform_info["unique_jc"].astype(str),
+            category=isoform_info["category"].astype(str)
+        )
+    if matrix is None:
+        matrix = pd.read_csv(f"{out}/summarized/isoform_matrix.tsv", sep="\t")
+
+    samples = matrix.columns[1:].tolist() 
+    n_samples = len(samples)
+
+    isoform_info["category"] = isoform_info["category"].replace(dict(zip(categories_raw, categories)))
+
+    # Summary statistics
+    summary_stats = summary_statistics(isoform_info, matrix, samples)
+
+    # Prepare summary tables for PDF
+
+    # Table 1: Isoforms per Sample
+    isoforms_per_sample = summary_stats["isoforms_per_sample"]
+    isoforms_per_sample_df = pd.DataFrame({
+        "Sample": isoforms_per_sample.index,
+        "Isoform count": isoforms_per_sample.values
+    })
+
+    # Table 2: Isoforms per Category
+    cat_table = summary_stats["isoforms_per_category"].copy()
+    cat_table.index.name = "Sample"
+    cat_table.reset_index(inplace=True)
+
+    # Table 3: Mono- VS Multiexon
+    mono_multi_table = summary_stats["mono_vs_multi"].copy()
+    mono_multi_table.index.name = "Sample"
+    mono_multi_table.reset_index(inplace=True)
+
+    # Collect render tasks; the inputs of each are computed here so that
+    # tasks can run in any order, on any worker
+    fig_path = lambda name: f"{out}/summarized/{name}.{plot_format}"
+    args = (plot_format, dpi)
+    tasks = [(_write_stats_pdf, (f"{out}/summarized/sq_compare_stats.pdf", n_samples, isoform_info.shape[0],
+                                 isoforms_per_sample_df, cat_table, mono_multi_table))]
+
+    if n_samples < 7:
+        cat_counts_df = summary_stats["isoforms_per_category"]
+        tasks.append((_plot_category_counts, (fig_path("ujc_per_category"), *args, cat_counts_df)))
+        tasks.append((_plot_category_composition, (fig_path("ujc_category_composition"), *args, cat_counts_df)))
+
+    tasks.append((_plot_length_distribution, (fig_path("ujc_length_distribution"), *args, summary_stats["lengths"])))
+
+    # heatmap (if expression values provided)
+    values = _sample_values(matrix, samples)
+    if n_samples > 1 and values.nnz and values.max() > 1:
+        top = top_variable_rows(values, heatmap_top)
+        data = pd.DataFrame(values[top].toarray(), columns=samples,
+                            index=pd.Index(matrix["unique_jc"].values[top], name="unique_jc"))
+        tasks.append((_plot_clustermap, (fig_path("expression_clustermap"), *args, data, heatmap_cluster_rows)))
+
+    # sample intersections (UpSet)
+    intersections = intersection_counts(summary_stats["presence"], samples)
+    truncated = bool(top_intersections) and len(intersections) > top_intersections
+    if truncated:
+        intersections = intersections.head(top_intersections)
+    write_intersections(intersections, samples, f"{out}/summarized/intersections.tsv")
+    if n_samples > 1:
+        tasks.append((_plot_upset, (fig_path("upset_standard"), *args, intersections, samples, truncated)))
+
+    tasks.append((_plot_mono_multi, (fig_path("mono_multi_proportion"), *args, mono_multi_table)))
+
+    render(tasks, workers)
+    print(f"Plots saved to {out}/summarized/")
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize isoform metadata and expression matrices")
+    parser.add_argument(
+        "--out", required=True,
+        help="Output folder"
+    )
+    parser.add_argument(
+        "--plot_format", "--plot-format", default="jpeg", choices=PLOT_FORMATS,
+        help="Image format of the figures (default: jpeg)"
+    )
+    parser.add_argument(
+        "--dpi", type=int, default=300,
+        help="Resolution of raster figures (default: 300)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of processes rendering figures in parallel"
+    )
+    parser.add_argument(
+        "--top_intersections", type=int, default=DEFAULT_TOP_INTERSECTIONS,
+        help=f"Number of largest sample intersections in intersections.tsv and the UpSet plot; 0 for all (default: {DEFAULT_TOP_INTERSECTIONS})"
+    )
+    parser.add_argument(
+        "--heatmap_top", type=int, default=DEFAULT_HEATMAP_TOP,
+        help=f"Number of most variable UJCs in the expression clustermap (default: {DEFAULT_HEATMAP_TOP})"
+    )
+    parser.add_argument(
+        "--heatmap_cluster_rows", type=int, default=0,
+        help="Cluster a random subsample of this many clustermap rows and place the others next to their nearest clustered row (default: 0, cluster all rows)"
+    )
+    args = parser.parse_args()
+    if args.top_intersections < 0:
+        parser.error("--top_intersections must be 0 or more")
+    if args.heatmap_top < 1:
+        parser.error("--heatmap_top must be 1 or more")
+    if args.heatmap_cluster_rows < 0:
+        parser.error("--heatmap_cluster_rows must be 0 or more")
+
+    summarize(args.out, plot_format=args.plot_format, dpi=args.dpi, workers=args.workers,
+              top_intersections=args.top_intersections, heatmap_top=args.heatmap_top,
+              heatmap_cluster_rows=args.heatmap_cluster_rows)
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,249 @@
 #!/usr/bin/env python3
 import argparse
-import pickle
 from pathlib import Path
+from intermediate_store import read_store
+from universal_id import keys_for_universal_ids
+import numpy as np
 import pandas as pd
-import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.packages import importr
-
-# Import edgeR in R
-edgeR = importr("edgeR")
+from scipy.stats import rankdata
+
+"""
+TMM normalization (Robinson & Oshlack 2010), a NumPy port of edgeR's
+calcNormFactors(method="TMM") followed by cpm(normalized.lib.sizes=TRUE).
+Factors are computed once over the universal_id x sample count matrix,
+so every sample is trimmed against the same reference sample. Tables
+keep the raw counts; the factors are applied when the normalized
+expression and the isoform matrix are written.
+"""
+
+NORM_FACTORS_FILE = "norm_factors.tsv"
+
+def _tmm_factor(obs, ref, lib_obs, lib_ref, logratio_trim=0.3, sum_trim=0.05, a_cutoff=-1e10):
+    """TMM factor of one sample against the reference (edgeR's .calcFactorTMM)."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_r = np.log2((obs / lib_obs) / (ref / lib_ref))
+        abs_e = (np.log2(obs / lib_obs) + np.log2(ref / lib_ref)) / 2
+        v = (lib_obs - obs) / lib_obs / obs + (lib_ref - ref) / lib_ref / ref
+
+    # remove infinite values, cutoff based on A
+    fin = np.isfinite(log_r) & np.isfinite(abs_e) & (abs_e > a_cutoff)
+    log_r, abs_e, v = log_r[fin], abs_e[fin], v[fin]
+    if log_r.size == 0 or np.max(np.abs(log_r)) < 1e-6:
+        return 1.0
+
+    # trim by rank: logratio_trim on M, sum_trim on A
+    n = log_r.size
+    lo_l = np.floor(n * logratio_trim) + 1
+    hi_l = n + 1 - lo_l
+    lo_s = np.floor(n * sum_trim) + 1
+    hi_s = n + 1 - lo_s
+    rank_r = rankdata(log_r)
+    rank_e = rankdata(abs_e)
+    keep = (rank_r >= lo_l) & (rank_r <= hi_l) & (rank_e >= lo_s) & (rank_e <= hi_s)
+
+    # precision-weighted mean of the kept log ratios
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = np.nansum(log_r[keep] / v[keep]) / np.nansum(1 / v[keep])
+    if np.isnan(f):
+        f = 0.0
+    return 2 ** f
+
+def sample_counts(expr_df):
+    """Counts of one sample by the chain key of its universal IDs (duplicated IDs are summed)."""
+    expr_df = expr_df.dropna(subset=["universal_id"])
+    counts = pd.Series(expr_df["count"].to_numpy(), index=keys_for_universal_ids(expr_df["universal_id"]))
+    return counts.groupby(level=0).sum()
+
+def _count_keys(samples, counts):
+    """
+    Sorted chain keys of the count matrix of samples (see cohort_norm_factors),
+    and those with a count in any sample. Keys are merged in batches as
+    large as the union so far, so merging stays close to linear.
+    """
+    index, expressed = np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    pending, n_pending = [], 0
+    for i, sample in enumerate(samples):
+        by_key = counts(sample)
+        keys = by_key.index.to_numpy()
+        pending.append((keys, keys[by_key.to_numpy() > 0]))
+        n_pending += len(keys)
+        if n_pending > len(index) or i == len(samples) - 1:
+            index = np.unique(np.concatenate([index] + [k for k, _ in pending]))
+            expressed = np.unique(np.concatenate([expressed] + [e for _, e in pending]))
+            pending, n_pending = [], 0
+    return index, expressed
+
+def calc_norm_factors(counts):
+    """
+    TMM normalization factors of a count matrix (features x samples),
+    scaled to multiply to one as in edgeR.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        Non-negative counts, one column per sample.
+
+    Returns
+    -------
+    numpy.ndarray
+        One factor per sample.
+    """
+    counts = np.asarray(counts, dtype=float)
+    n_samples = counts.shape[1]
+    lib_size = counts.sum(axis=0)
+
+    # remove all zero rows
+    counts = counts[(counts > 0).any(axis=1)]
+    if counts.shape[0] == 0 or n_samples == 1:
+        return np.ones(n_samples)
+
+    # reference sample: upper quartile closest to the mean upper quartile
+    f75 = np.quantile(counts, 0.75, axis=0) / lib_size
+    if np.median(f75) < 1e-20:
+        ref_column = int(np.argmax(np.sqrt(counts).sum(axis=0)))
+    else:
+        ref_column = int(np.argmin(np.abs(f75 - f75.mean())))
+
+    ref = counts[:, ref_column]
+    factors = np.array([
+        _tmm_factor(counts[:, j], ref, lib_size[j], lib_size[ref_column])
+        for j in range(n_samples)
+    ])
+
+    # factors should multiply to one
+    return factors / np.exp(np.mean(np.log(factors)))
+
+def cohort_norm_factors(samples, counts):
+    """
+    calc_norm_factors over the universal_id x sample count matrix of a
+    cohort (rows in chain key order), with one sample in memory at a time:
+    counts(sample) -> counts by chain key (see sample_counts) is called in
+    passes over the samples (IDs and expressed IDs, library sizes and upper
+    quartiles, TMM factors against the reference sample).
+    Returns a DataFrame indexed by sample with lib_size and norm_factor.
+    """
+    factors = pd.DataFrame({"lib_size": np.zeros(len(samples)), "norm_factor": np.ones(len(samples))},
+                           index=pd.Index(samples, name="sample"))
+    if not samples:
+        return factors
+
+    # pass 1: the IDs of the count matrix and those with a count in any sample
+    index, expressed = _count_keys(samples, counts)
+    rows = np.searchsorted(index, expressed)
+    def column(sample):
+        values = np.zeros(len(index))
+        by_key = counts(sample)
+        values[np.searchsorted(index, by_key.index.to_numpy())] = by_key.to_numpy(dtype=float)
+        return values
+
+    # pass 2: library sizes and reference sample, from the expressed rows
+    n = len(samples)
+    lib_size, f75, sqrt_sum = np.zeros(n), np.zeros(n), np.zeros(n)
+    for j, sample in enumerate(samples):
+        values = column(sample)
+        lib_size[j] = values.sum()
+        if len(rows):
+            f75[j] = np.quantile(values[rows], 0.75) / lib_size[j]
+            sqrt_sum[j] = np.sqrt(values[rows]).sum()
+    factors["lib_size"] = lib_size
+    if len(rows) and n > 1:
+        if np.median(f75) < 1e-20:
+            ref_column = int(np.argmax(sqrt_sum))
+        else:
+            ref_column = int(np.argmin(np.abs(f75 - f75.mean())))
+
+        # pass 3: TMM factors against the reference sample
+        ref = column(samples[ref_column])[rows]
+        tmm = np.array([_tmm_factor(column(sample)[rows], ref, lib_size[j], lib_size[ref_column])
+                        for j, sample in enumerate(samples)])
+        # factors should multiply to one
+        factors["norm_factor"] = tmm / np.exp(np.mean(np.log(tmm)))
+    return factors
+
+def effective_lib_sizes(factors):
+    """Normalized library sizes (library size x TMM factor) by sample."""
+    return factors["lib_size"] * factors["norm_factor"]
+
+def _cpm(expr_df, lib):
+    """CPM of expression rows with a normalized library size."""
+    return pd.DataFrame({
+        "universal_id": expr_df["universal_id"].values,
+        "count": expr_df["count"].values / lib * 1e6
+    })
 
 def normalize_expression(expr_dfs):
     """
-    Normalize a dictionary of expression dataframes with edgeR TMM.
-    Assumes each df has gene_id rows and count columns.
+    TMM-normalize a dictionary of expression dataframes (universal_id, count)
+    as one cohort. Returns sample -> dataframe of CPM with normalized
+    library sizes, in the rows of the input dataframe.
     """
-    normalized = {}
+    expr_dfs = {s: df for s, df in expr_dfs.items() if df is not None}
+    factors = cohort_norm_factors(list(expr_dfs), lambda s: sample_counts(expr_dfs[s]))
+    return {sample: _cpm(expr_dfs[sample], lib) for sample, lib in effective_lib_sizes(factors).items()}
 
-    for sample, df in expr_dfs.items():
-        if df is None:
-            continue
-
-        # First column is assumed to be gene_id
-        gene_ids = df.iloc[:, 0]
-        counts_only = df.iloc[:, 1:]
-
-        # Use context manager for conversion
-        with pandas2ri.converter.context():
-            r_counts = pandas2ri.py2rpy(counts_only)
-            r_gene_ids = pandas2ri.py2rpy(gene_ids)
-
-        ro.globalenv['counts'] = r_counts
-        ro.globalenv['gene_ids'] = r_gene_ids
-
-        # Run edgeR normalization in R
-        ro.r('dge <- DGEList(counts=counts)')
-        ro.r('dge <- calcNormFactors(dge, method="TMM")')
-        norm_r = ro.r('cpm(dge, normalized.lib.sizes=TRUE)')
-
-        # Back-convert to pandas
-        with pandas2ri.converter.context():
-            norm_df = pandas2ri.rpy2py(norm_r)
+def normalize_samples(samples, expression, out, counts=None):
+    """
+    TMM-normalize the expression of a cohort of samples with expression,
+    one sample in memory at a time: expression(sample) -> dataframe
+    (universal_id, count) of raw counts. counts(sample) -> its counts by
+    chain key (default: sample_counts of its expression; e.g. read from
+    the UJC catalog instead) is called once per sample, and the counts
+    are kept for the passes of cohort_norm_factors.
+    Writes per-sample TSVs of CPM with normalized library sizes to
+    <out>/normalized_expression and the factors to norm_factors.tsv there.
+    Returns the factors (see cohort_norm_factors).
+    """
+    counts = counts or (lambda s: sample_counts(expression(s)))
+    cached = {}
+    def cohort_counts(sample):
+        if sample not in cached:
+            cached[sample] = counts(sample)
+        return cached[sample]
+    factors = cohort_norm_factors(samples, cohort_counts)
+
+    out_dir = Path(f"{out}/normalized_expression")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for sample, lib in effective_lib_sizes(factors).items():
+        out_file = out_dir / f"{sample}_normalized_expression.tsv"
+        _cpm(expression(sample), lib).to_csv(out_file, sep="\t", index=True)
+        print(f"Saved {out_file}")
+    factors.to_csv(out_dir / NORM_FACTORS_FILE, sep="\t")
 
-        #norm_df.index = gene_ids
-        #norm_df.columns = counts_only.columns
-        norm_df = pd.DataFrame(norm_df,
-                       index=gene_ids,
-                       columns=counts_only.columns)
+    print(f"Normalized expression for {len(samples)} samples")
+    return factors
 
-        normalized[sample] = norm_df
+def read_norm_factors(out):
+    """The factors written by normalize_samples to <out>/normalized_expression, or None."""
+    path = Path(f"{out}/normalized_expression") / NORM_FACTORS_FILE
+    if not path.exists():
+        return None
+    return pd.read_csv(path, sep="\t", index_col="sample", float_precision="round_trip")
 
-    return normalized
+def normalize_matrix(matrix, factors):
+    """
+    CPM with normalized library sizes of the raw count columns of a
+    (sparse) isoform matrix; columns of samples without factors (presence)
+    are kept as they are.
+    """
+    lib_sizes = effective_lib_sizes(factors)
+    return pd.DataFrame({
+        sample: matrix[sample] / lib_sizes[sample] * 1e6 if sample in lib_sizes.index else matrix[sample]
+        for sample in matrix.columns
+    }, index=matrix.index)
 
 def main():
-    parser = argparse.ArgumentParser(description="Normalize expression values with edgeR TMM")
-    parser.add_argument("--pickle", required=True,
-                        help="Pickle file produced by sqanti3_parser.py")
+    parser = argparse.ArgumentParser(description="Normalize expression values with TMM")
+    parser.add_argument("--store", required=True,
+                        help="Intermediate store produced by universal_id.py (<out>/sqanti3_standardized)")
     parser.add_argument("--out", required=True,
-                        help="Path to output folder for normalized expression")
+                        help="Path to output folder for normalized expression and factors")
     args = parser.parse_args()
 
-    # Load parsed object
-    with open(args.pickle, "rb") as f:  # fixed arg name
-        parsed = pickle.load(f)
-
-    expr_dfs = {s: parsed["data"][s]["expression"][['universal_id', 'count']] for s in parsed["samples"]}
-
-    # Normalize
-    norm_expr = normalize_expression(expr_dfs)
-
-    out_dir = Path(f"{args.out}/normalized_expression")
-    out_dir.mkdir(parents=True, exist_ok=True)
-
-    # Save per-sample TSVs
-    for sample, df in norm_expr.items():
-        df.reset_index(inplace=True)
-        out_file = out_dir / f"{sample}_normalized_expression.tsv"
-        df.to_csv(out_file, sep="\t", index=True)
-        parsed["data"][sample]["expression"] = df
-        print(f"Saved {out_file}")
-
-    # Save updated pickle with normalized expression
-    #parsed["normalized_expression"] = norm_expr
-    out_file = f"{args.out}/sqanti3_normalized.pkl"
-    with open(out_file, "wb") as f:
-        pickle.dump(parsed, f)
+    # Load expression only
+    parsed = read_store(args.store, tables=["expression"])
 
-    print(f"Normalized expression for {len(norm_expr)} samples")
-    print(f"Results saved to {out_file}")
+    samples = [s for s in parsed["samples"] if parsed["data"][s]["expression"] is not None]
+    normalize_samples(samples, lambda s: parsed["data"][s]["expression"], args.out)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
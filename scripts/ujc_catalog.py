@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from universal_id import keys_for_universal_ids, universal_id_for_key, universal_ids_for_keys
+
+"""
+Persistent UJC catalog kept in the output folder (ujc_catalog.pkl).
+It holds every junction chain seen so far with its universal ID and
+metadata, plus one matrix column per sample (raw counts, or presence)
+and the raw expression rows of every sample, so new samples can be
+merged in and the cohort normalized again without reprocessing the
+existing ones.
+"""
+
+CATALOG_FILE = "ujc_catalog.pkl"
+CATALOG_VERSION = 4   # 2: chains keyed by integer chain key; 3: chain labels; 4: raw counts
+
+# Catalogs saved before a parameter existed were built with its default
+PARAM_DEFAULTS = {"chain_mode": "exon", "junction_tolerance": 0}
+
+def catalog_path(out):
+    return os.path.join(out, CATALOG_FILE)
+
+def load_catalog(out):
+    """Load the UJC catalog from an output folder."""
+    path = catalog_path(out)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No UJC catalog found at {path}; run the pipeline once without --append first")
+    with open(path, "rb") as f:
+        catalog = pickle.load(f)
+    if catalog.get("version") != CATALOG_VERSION:
+        raise ValueError(f"UJC catalog at {path} has an older format; run the pipeline again without --append")
+    if catalog.get("params") is not None:
+        catalog["params"] = {**PARAM_DEFAULTS, **catalog["params"]}
+    return catalog
+
+def save_catalog(catalog, out):
+    """Write the UJC catalog to an output folder."""
+    path = catalog_path(out)
+    catalog["version"] = CATALOG_VERSION
+    with open(path, "wb") as f:
+        pickle.dump(catalog, f)
+    print(f"UJC catalog ({len(catalog['chains'])} UJCs, {len(catalog['samples'])} samples) saved to {path}")
+
+def check_params(catalog, params):
+    """Raise if samples processed with `params` cannot be merged into the catalog."""
+    if catalog.get("params") != params:
+        raise ValueError(f"Catalog was built with {catalog.get('params')}, new samples with {params}")
+
+def expression_rows(expr_df):
+    """
+    Raw expression rows of a sample as kept in the catalog: chain key
+    (<NA> for isoforms without a universal ID) and count, in input order.
+    """
+    mapped = expr_df["universal_id"].notna().to_numpy()
+    keys = np.zeros(len(expr_df), dtype=np.int64)
+    keys[mapped] = keys_for_universal_ids(expr_df["universal_id"][mapped])
+    return pd.DataFrame({
+        "chain_key": pd.arrays.IntegerArray(keys, ~mapped),
+        "count": expr_df["count"].values
+    })
+
+def catalog_expression(catalog, sample):
+    """Raw expression rows (universal_id, count) of a catalog sample, or None."""
+    rows = catalog["expression"].get(sample)
+    if rows is None:
+        return None
+    mapped = rows["chain_key"].notna().to_numpy()
+    universal_ids = np.full(len(rows), np.nan, dtype=object)
+    universal_ids[mapped] = universal_ids_for_keys(rows["chain_key"].to_numpy(dtype=np.int64, na_value=0)[mapped])
+    return pd.DataFrame({
+        "universal_id": universal_ids,
+        "count": rows["count"].values
+    })
+
+def catalog_counts(catalog, sample):
+    """
+    Raw counts of a catalog sample by chain key (duplicated keys are
+    summed), as tmm_norm.sample_counts of its expression.
+    """
+    rows = catalog["expression"][sample]
+    rows = rows[rows["chain_key"].notna()]
+    counts = pd.Series(rows["count"].to_numpy(), index=rows["chain_key"].to_numpy(dtype=np.int64))
+    return counts.groupby(level=0).sum()
+
+def _check_shared_chains(old, new):
+    """
+    Raise if a chain key of both chain dictionaries stands for different
+    chains (chrom, labels and coordinates): keys are 64-bit digests (see
+    universal_id.chain_key), so distinct chains could in principle collide.
+    """
+    shared = old.index.intersection(new.index)
+    old, new = old.loc[shared], new.loc[shared]
+    for key, chrom, labels, coords, new_chrom, new_labels, new_coords in zip(
+            shared, old["chrom"].astype(str), old["labels"], old["coords"],
+            new["chrom"].astype(str), new["labels"], new["coords"]):
+        if chrom != new_chrom or tuple(labels) != tuple(new_labels) or coords.tobytes() != new_coords.tobytes():
+            raise ValueError(f"Chain key collision: {universal_id_for_key(key)} stands for two junction chains "
+                             f"({chrom} and {new_chrom})")
+
+def _reindex(matrix, index):
+    """Reindex matrix rows with 0 for missing chains, keeping the (sparse) dtypes."""
+    return matrix.reindex(index, fill_value=0).astype(matrix.dtypes.to_dict())
+
+def merge_catalogs(catalog, new):
+    """
+    Add the samples of `new` to `catalog`.
+    Chains already in the catalog keep their ID and metadata (as "first"
+    would in a full run); their lengths are pooled. New chains are appended.
+    Matrix cells of chains a sample does not have are 0 (sparse).
+    Raises ValueError if a chain key stands for different chains in the two.
+    """
+    overlap = set(catalog["samples"]) & set(new["samples"])
+    if overlap:
+        raise ValueError(f"Samples already in the UJC catalog: {', '.join(sorted(overlap))}")
+    check_params(catalog, new.get("params"))
+
+    _check_shared_chains(catalog["chains"], new["chains"])
+
+    chains = pd.concat([catalog["chains"], new["chains"]])
+    chains = chains.groupby(level=0, sort=False).agg({
+        "chrom": "first",
+        "labels": "first",
+        "coords": "first",
+        "category": "first",
+        "associated_gene": "first",
+        "associated_transcript": "first",
+        "exons_n": "first",
+        "length_sum": "sum",
+        "length_n": "sum"
+    })
+    chains["chrom"] = chains["chrom"].astype("category")
+
+    matrix = pd.concat([
+        _reindex(catalog["matrix"], chains.index),
+        _reindex(new["matrix"], chains.index)
+    ], axis=1)
+
+    return {
+        "samples": catalog["samples"] + new["samples"],
+        "params": catalog.get("params"),
+        "chains": chains,
+        "matrix": matrix,
+        "expression": {**catalog["expression"], **new["expression"]}
+    }
+
+def concat_catalogs(catalogs, samples):
+    """
+    Concatenate catalogs of disjoint chains over the same samples (e.g. one
+    per chromosome), in chain key order as build_catalog returns them.
+    """
+    chains = pd.concat([c["chains"] for c in catalogs])
+    if chains.index.has_duplicates:
+        key = chains.index[chains.index.duplicated()][0]
+        raise ValueError(f"Chain key collision: {universal_id_for_key(key)} stands for chains of several shards")
+    matrix = pd.concat([c["matrix"][samples] for c in catalogs])
+    order = np.argsort(chains.index.to_numpy(), kind="stable")
+    chains = chains.iloc[order]
+    chains["chrom"] = chains["chrom"].astype(str).astype("category")
+    return {
+        "samples": list(samples),
+        "chains": chains,
+        "matrix": matrix.iloc[order].astype(matrix.dtypes.to_dict())
+    }
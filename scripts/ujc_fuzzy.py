@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import numpy as np
+
+"""
+Approximate UJC matching (sq_compare.py --junction_tolerance N): junction
+chains whose coordinates all differ by at most N bp are merged into one
+representative chain, which gives them their universal ID.
+
+Only chains with the same chromosome, strand and number of coordinates
+can match. Within such a group the chains are indexed by their first
+coordinate (a sorted array searched with searchsorted), so a chain is only
+compared with the chains starting within N bp of it rather than with all
+others. Chains are visited from the most to the least supported (number of
+transcripts, then coordinates), and each joins the best supported
+representative within N bp at every coordinate, or becomes a representative
+itself. Members are therefore within N bp of their representative; merges
+do not chain transitively.
+"""
+
+def _prefix_len(chain):
+    """Number of leading non-coordinate elements of a chain (chromosome, strand, ...)."""
+    n = 0
+    while n < len(chain) and isinstance(chain[n], str):
+        n += 1
+    return n
+
+def _merge_group(coords, counts, tolerance):
+    """
+    Representative (row) of every row of a group's coordinate matrix
+    (chains x coordinates), for chains with support `counts`.
+    """
+    n = len(coords)
+    # visiting order: most transcripts first, ties by coordinates
+    order = np.lexsort(tuple(coords.T[::-1]) + (-counts,))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+
+    # sorted index on the first coordinate: candidates of row i are by_first[lo[i]:hi[i]]
+    by_first = np.argsort(coords[:, 0], kind="stable")
+    firsts = coords[by_first, 0]
+    lo = np.searchsorted(firsts, coords[:, 0] - tolerance, side="left")
+    hi = np.searchsorted(firsts, coords[:, 0] + tolerance, side="right")
+
+    rep_of = np.arange(n)
+    is_rep = hi - lo == 1   # nothing starts nearby
+    for i in order[~is_rep[order]]:
+        window = by_first[lo[i]:hi[i]]
+        candidates = window[is_rep[window]]
+        close = candidates[np.abs(coords[candidates] - coords[i]).max(axis=1) <= tolerance]
+        if len(close):
+            rep_of[i] = close[np.argmin(rank[close])]
+        else:
+            is_rep[i] = True
+    return rep_of
+
+def merge_near_chains(chain_counts, tolerance):
+    """
+    Merge junction chains within `tolerance` bp of each other.
+
+    Parameters
+    ----------
+    chain_counts : dict
+        Chain (tuple: chromosome and other labels, then coordinates) ->
+        number of transcripts with that chain.
+    tolerance : int
+        Largest difference in bp allowed at every coordinate.
+
+    Returns
+    -------
+    dict
+        Chain -> representative chain, for the chains merged into another.
+    """
+    groups = {}
+    for chain in chain_counts:
+        n = _prefix_len(chain)
+        groups.setdefault((chain[:n], len(chain) - n), []).append(chain)
+
+    representatives = {}
+    for (prefix, n_coords), chains in groups.items():
+        if n_coords == 0 or len(chains) == 1:
+            continue
+        coords = np.array([chain[len(prefix):] for chain in chains], dtype=np.int64)
+        counts = np.array([chain_counts[chain] for chain in chains], dtype=np.int64)
+        rep_of = _merge_group(coords, counts, tolerance)
+        representatives.update(
+            (chains[i], chains[r]) for i, r in enumerate(rep_of) if i != r
+        )
+    return representatives
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from universal_id import universal_id_for_key
+
+"""
+Memory-mapped UJC index written next to the summarized tables, so single
+genes or regions can be looked up without parsing isoform_info.tsv and
+isoform_matrix.tsv.
+
+<out>/ujc_index/
+    meta.json               samples, chromosomes with their offsets, categories
+    ujcs.npy                one record per UJC, sorted by (chrom, start, end)
+    universal_id.npy        universal IDs (bytes)
+    transcript.npy          associated transcripts (bytes)
+    labels.npy              strand and mono-exon mark of intron chains (bytes, comma-separated)
+    coords.npy              junction chain coordinates of all UJCs (int32) ...
+    coord_offsets.npy       ... and where each UJC's coordinates start
+    genes.npy               sorted associated gene names (bytes) ...
+    gene_offsets.npy        ... their offsets into
+    gene_ujcs.npy           UJC positions grouped by gene
+    matrix_{indptr,indices,data}.npy
+                            isoform matrix rows (CSR) in index order
+
+python sq_compare.py query --out /path/to/output/folder --region chr22:1-5e6
+python sq_compare.py query --out /path/to/output/folder --gene ENSG00000100031
+"""
+
+INDEX_DIR = "ujc_index"
+INDEX_VERSION = 2
+
+UJC_DTYPE = np.dtype([
+    ("chrom", np.int32), ("start", np.int32), ("end", np.int32),
+    ("max_end", np.int32),   # running maximum of end within the chromosome
+    ("exons_n", np.int32), ("category", np.int16), ("gene", np.int32),
+    ("length", np.float64)
+])
+
+def index_path(out):
+    return os.path.join(out, INDEX_DIR)
+
+def _encode(values):
+    """Strings as a fixed-width bytes array (missing values as empty strings)."""
+    values = ["" if pd.isna(v) else str(v) for v in values]
+    return np.array(values, dtype=bytes) if values else np.array([], dtype="S1")
+
+def write_ujc_index(catalog, out):
+    """Write the memory-mapped UJC index of a catalog to <out>/ujc_index."""
+    chains = catalog["chains"]
+    n = len(chains)
+    chroms = chains["chrom"].astype(str).to_numpy()
+    coords = chains["coords"].to_numpy()
+    starts = np.array([c[0] if len(c) else 0 for c in coords], dtype=np.int32)
+    ends = np.array([c[-1] if len(c) else 0 for c in coords], dtype=np.int32)
+
+    chrom_names, chrom_codes = np.unique(chroms, return_inverse=True)
+    order = np.lexsort((ends, starts, chrom_codes))
+    chrom_offsets = np.searchsorted(chrom_codes[order], np.arange(len(chrom_names) + 1))
+
+    categories = sorted(chains["category"].astype(str).unique())
+    genes = chains["associated_gene"].to_numpy()[order]
+    gene_names, gene_codes = np.unique(_encode(genes), return_inverse=True)
+
+    ujcs = np.zeros(n, dtype=UJC_DTYPE)
+    ujcs["chrom"] = chrom_codes[order]
+    ujcs["start"] = starts[order]
+    ujcs["end"] = ends[order]
+    for lo, hi in zip(chrom_offsets[:-1], chrom_offsets[1:]):
+        ujcs["max_end"][lo:hi] = np.maximum.accumulate(ujcs["end"][lo:hi])
+    ujcs["exons_n"] = chains["exons_n"].to_numpy()[order]
+    ujcs["category"] = pd.Categorical(chains["category"].astype(str), categories=categories).codes[order]
+    ujcs["gene"] = gene_codes
+    ujcs["length"] = (chains["length_sum"].to_numpy() / chains["length_n"].to_numpy())[order]
+
+    ordered_coords = [np.asarray(coords[i], dtype=np.int32) for i in order]
+    coord_offsets = np.concatenate(([0], np.cumsum([len(c) for c in ordered_coords]))).astype(np.int64)
+
+    matrix = catalog["matrix"].reindex(chains.index)
+    if all(isinstance(t, pd.SparseDtype) for t in matrix.dtypes):
+        csr = matrix.sparse.to_coo().tocsr()
+    else:
+        csr = sp.csr_matrix(matrix.to_numpy())
+    csr = csr[order]
+
+    path = index_path(out)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    arrays = {
+        "ujcs": ujcs,
+        "universal_id": _encode([universal_id_for_key(k) for k in chains.index[order]]),
+        "transcript": _encode(chains["associated_transcript"].to_numpy()[order]),
+        "labels": _encode([",".join(labels) for labels in chains["labels"].to_numpy()[order]]),
+        "coords": np.concatenate(ordered_coords) if n else np.array([], dtype=np.int32),
+        "coord_offsets": coord_offsets,
+        "genes": gene_names,
+        "gene_offsets": np.searchsorted(np.sort(gene_codes), np.arange(len(gene_names) + 1)),
+        "gene_ujcs": np.argsort(gene_codes, kind="stable"),
+        "matrix_indptr": csr.indptr,
+        "matrix_indices": csr.indices,
+        "matrix_data": csr.data
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+    meta = {
+        "version": INDEX_VERSION,
+        "samples": list(matrix.columns),
+        "chroms": chrom_names.tolist(),
+        "chrom_offsets": chrom_offsets.tolist(),
+        "categories": categories
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+    print(f"UJC index ({n} UJCs) saved to {path}")
+
+def open_ujc_index(out):
+    """Open the UJC index of an output folder; arrays are memory-mapped."""
+    path = index_path(out)
+    with open(os.path.join(path, "meta.json")) as f:
+        index = json.load(f)
+    if index.get("version") != INDEX_VERSION:
+        raise ValueError(f"UJC index at {path} has an unsupported format; rerun the pipeline")
+    for name in os.listdir(path):
+        if name.endswith(".npy"):
+            index[name[:-4]] = np.load(os.path.join(path, name), mmap_mode="r")
+    return index
+
+def parse_region(region):
+    """chr:start-end (1-based, inclusive; e.g. chr22:1-5e6) -> (chr, start, end)."""
+    chrom, _, span = region.rpartition(":")
+    if not chrom:
+        return region, 1, np.iinfo(np.int32).max
+    start, _, end = span.partition("-")
+    return chrom, int(float(start)), int(float(end)) if end else np.iinfo(np.int32).max
+
+def query_region(index, chrom, start, end):
+    """Index positions of the UJCs overlapping chrom:start-end."""
+    if chrom not in index["chroms"]:
+        return np.array([], dtype=np.int64)
+    c = index["chroms"].index(chrom)
+    lo, hi = index["chrom_offsets"][c], index["chrom_offsets"][c + 1]
+    ujcs = index["ujcs"]
+    # UJCs starting after `end` cannot overlap; max_end is non-decreasing
+    first = lo + np.searchsorted(ujcs["max_end"][lo:hi], start, side="left")
+    last = lo + np.searchsorted(ujcs["start"][lo:hi], end, side="right")
+    candidates = np.arange(first, max(first, last))
+    return candidates[ujcs["end"][first:max(first, last)] >= start]
+
+def query_gene(index, gene):
+    """Index positions of the UJCs associated with a gene."""
+    genes = index["genes"]
+    key = gene.encode()
+    i = np.searchsorted(genes, key)
+    if i == len(genes) or genes[i] != key:
+        return np.array([], dtype=np.int64)
+    offsets = index["gene_offsets"]
+    return np.sort(index["gene_ujcs"][offsets[i]:offsets[i + 1]])
+
+def ujc_records(index, positions):
+    """isoform_info and isoform_matrix columns of the UJCs at index positions."""
+    ujcs = index["ujcs"][positions]
+    coords, offsets = index["coords"], index["coord_offsets"]
+    chroms = index["chroms"]
+    labels = [label.split(",") if label else [] for label in np.char.decode(index["labels"][positions])]
+    unique_jc = [
+        str(tuple([chroms[c]] + label + coords[offsets[p]:offsets[p + 1]].tolist()))
+        for p, c, label in zip(positions, ujcs["chrom"], labels)
+    ]
+    records = pd.DataFrame({
+        "unique_jc": unique_jc,
+        "universal_id": np.char.decode(index["universal_id"][positions]),
+        "category": np.array(index["categories"], dtype=object)[ujcs["category"]],
+        "associated_gene": np.char.decode(index["genes"][ujcs["gene"]]),
+        "associated_transcript": np.char.decode(index["transcript"][positions]),
+        "exons_n": ujcs["exons_n"],
+        "length": ujcs["length"]
+    })
+    indptr = index["matrix_indptr"]
+    values = np.zeros((len(positions), len(index["samples"])), dtype=index["matrix_data"].dtype)
+    for i, p in enumerate(positions):
+        values[i, index["matrix_indices"][indptr[p]:indptr[p + 1]]] = index["matrix_data"][indptr[p]:indptr[p + 1]]
+    return pd.concat([records, pd.DataFrame(values, columns=index["samples"])], axis=1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sq_compare.py query",
+                                     description="Look up UJCs by region or gene in the UJC index of an output folder")
+    parser.add_argument("--out", required=True,
+                        help="Output folder of a pipeline run")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--region",
+                        help="chr:start-end (1-based, inclusive, e.g. chr22:1-5e6) or a whole chromosome")
+    target.add_argument("--gene",
+                        help="associated_gene, e.g. ENSG00000100031")
+    args = parser.parse_args(argv)
+
+    index = open_ujc_index(args.out)
+    if args.region:
+        positions = query_region(index, *parse_region(args.region))
+    else:
+        positions = query_gene(index, args.gene)
+    ujc_records(index, positions).to_csv(sys.stdout, sep="\t", index=False)
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,265 @@
 #!/usr/bin/env python3
 import argparse
-import pickle
+import hashlib
 from pathlib import Path
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from collections import Counter
+from sample_cache import cached_table
+from ujc_fuzzy import merge_near_chains
+from intermediate_store import read_store, write_store
 
 """
-python standardize_isoform_ids_gtf.py \
-    --pickle results/sqanti3_normalized.pkl \
+python universal_id.py \
+    --store results/sqanti3_samples \
     --out output_folder
 
 """
 
+GTF_COLUMNS = ["chr", "source", "feature", "start", "end",
+               "score", "strand", "frame", "attribute"]
+
+TRANSCRIPT_ID_RE = r'transcript_id "([^"]+)"'
+
+# GTF lines parsed at a time by read_gtf
+GTF_CHUNK_ROWS = 500_000
+
+GTF_CATEGORICAL = ["transcript_id", "chr", "strand"]
+
+# exon: every exon start and end; intron: internal junctions and strand only
+CHAIN_MODES = ["exon", "intron"]
+
+# Marks the exon coordinates of mono-exonic transcripts in intron chains
+MONOEXON = "monoexon"
+
+def read_gtf(gtf_path, chunk_rows=GTF_CHUNK_ROWS):
+    """
+    Stream a GTF in chunks, keeping only exon records as a compact table:
+    transcript_id, chr and strand (categorical; transcript_id categories
+    sorted), start and end (int32). transcript_id is extracted once while
+    streaming; attribute strings and non-exon records are never kept.
+    """
+    reader = pd.read_csv(
+        gtf_path, sep="\t", header=None, names=GTF_COLUMNS,
+        usecols=["chr", "feature", "start", "end", "strand", "attribute"],
+        dtype={"chr": "category", "feature": str, "start": np.int32, "end": np.int32,
+               "strand": "category", "attribute": str},
+        chunksize=chunk_rows
+    )
+    parts = []
+    for chunk in reader:
+        exons = chunk[chunk["feature"] == "exon"]
+        parts.append(pd.DataFrame({
+            "transcript_id": exons["attribute"].str.extract(TRANSCRIPT_ID_RE, expand=False).astype("category"),
+            "chr": exons["chr"],
+            "strand": exons["strand"],
+            "start": exons["start"],
+            "end": exons["end"]
+        }))
+    if not parts:
+        # no lines at all: an empty table with the dtypes of the chunks
+        return pd.DataFrame({
+            "transcript_id": pd.Categorical([]),
+            "chr": pd.Categorical([]),
+            "strand": pd.Categorical([]),
+            "start": np.array([], dtype=np.int32),
+            "end": np.array([], dtype=np.int32)
+        })
+
+    return pd.DataFrame({
+        col: (union_categoricals([p[col] for p in parts], sort_categories=True)
+              if col in GTF_CATEGORICAL else np.concatenate([p[col].to_numpy() for p in parts]))
+        for col in parts[0].columns
+    })
+
 def extract_junction_chain_from_gtf(gtf_file):
     """
-    Extract junction chains from a GTF file.
+    Extract junction chains from a GTF file (the exon table of read_gtf, or
+    a raw 9-column frame).
     Returns dict: transcript_id -> list of junction coordinates [chr, start1, end1, start2, end2,...]
     """
-    chains = {}
-    #gtf = pd.read_csv(gtf_file, sep="\t", comment="#", header=None,
-    #                  names=["chr", "source", "feature", "start", "end",
-    #                         "score", "strand", "frame", "attribute"])
-    gtf_file.columns = ["chr", "source", "feature", "start", "end",
-                         "score", "strand", "frame", "attribute"]
-    exons = gtf_file[gtf_file["feature"] == "exon"].copy()
-    
-    # Extract transcript_id
-    def get_transcript_id(attr):
-        for field in attr.split(";"):
-            if 'transcript_id' in field:
-                return field.split('"')[1]
-        return None
-    
-    exons["transcript_id"] = exons["attribute"].apply(get_transcript_id)
-    
-    # Group by transcript_id
-    for tid, df in exons.groupby("transcript_id"):
-        df_sorted = df.sort_values("start")
-        # Junction chain: [chr, start1, end1, start2, end2, ...]
-        chain = [df_sorted.iloc[0]["chr"]]
-        for _, row in df_sorted.iterrows():
-            chain.extend([row["start"], row["end"]])
-        chains[tid] = chain
+    if "transcript_id" in gtf_file.columns:
+        exons = gtf_file[["chr", "start", "end", "transcript_id"]]
+    else:
+        gtf = gtf_file.set_axis(GTF_COLUMNS, axis=1)
+        exons = gtf.loc[gtf["feature"] == "exon", ["chr", "start", "end", "attribute"]]
+        # Extract transcript_id (one regex pass over all exon attributes)
+        exons = exons.assign(transcript_id=exons["attribute"].str.extract(TRANSCRIPT_ID_RE, expand=False))
+    exons = exons.dropna(subset=["transcript_id"])
+    if exons.empty:
+        return {}
+
+    # One global sort by (transcript_id, start), then split into per-transcript blocks
+    exons = exons.sort_values(["transcript_id", "start"], kind="mergesort")
+    tids = exons["transcript_id"].to_numpy()
+    bounds = np.flatnonzero(tids[1:] != tids[:-1]) + 1
+    firsts = np.concatenate(([0], bounds))
+
+    # Junction chain: [chr, start1, end1, start2, end2, ...]
+    coords = exons[["start", "end"]].to_numpy().ravel()
+    blocks = np.split(coords, 2 * bounds)
+    chroms = exons["chr"].to_numpy()[firsts]
+    chains = {
+        tid: [chrom] + block.tolist()
+        for tid, chrom, block in zip(tids[firsts], chroms, blocks)
+    }
 
     return chains
 
-def standardize_isoforms_cross_sample(pickle_df, out_dir=None):
+def cached_junction_chains(gtf_path, gtf_file, cache_dir):
+    """
+    extract_junction_chain_from_gtf for the GTF read from gtf_path, served from
+    the per-sample cache (see sample_cache.py) when the file is unchanged.
+    """
+    def extract(_):
+        chains = extract_junction_chain_from_gtf(gtf_file)
+        return pd.DataFrame({
+            "transcript_id": list(chains),
+            "chr": [chain[0] for chain in chains.values()],
+            "coords": [chain[1:] for chain in chains.values()]
+        })
+
+    table = cached_table(cache_dir, gtf_path, "chains", extract)
+    return {
+        tid: [chrom] + np.asarray(coords).tolist()
+        for tid, chrom, coords in zip(table["transcript_id"], table["chr"], table["coords"])
+    }
+
+def chain_key(chain):
+    """
+    64-bit integer key of a junction chain: the BLAKE2 digest of the chain
+    ("chr22,10738829,10739148") as a signed int64.
+    """
+    digest = hashlib.blake2b(",".join(str(x) for x in chain).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+def universal_id_for_key(key):
+    """Universal isoform ID of a chain key: "isoform_" followed by the digest in hex."""
+    return "isoform_" + int(key).to_bytes(8, "big", signed=True).hex()
+
+def universal_ids_for_keys(keys):
+    """Universal IDs of chain keys (int64 array), as universal_id_for_key for each."""
+    digests = np.asarray(keys, dtype=">i8").tobytes().hex()
+    return ["isoform_" + digests[i:i + 16] for i in range(0, len(digests), 16)]
+
+def keys_for_universal_ids(universal_ids):
+    """Chain keys (int64 array) of universal IDs, the inverse of universal_id_for_key."""
+    digests = "".join(uid[len("isoform_"):] for uid in universal_ids)
+    return np.frombuffer(bytes.fromhex(digests), dtype=">i8").astype(np.int64)
+
+def universal_id_for_chain(chain):
+    """
+    Universal isoform ID for a junction chain.
+    The same chain gets the same ID in every run, sample set and order.
+    """
+    return universal_id_for_key(chain_key(chain))
+
+def register_chain_key(registry, key, chain):
+    """
+    Record chain key -> chain (tuple) in registry. Raises ValueError if the
+    key already stands for another chain: keys are 64-bit digests, so
+    distinct chains could in principle collide.
+    """
+    registered = registry.setdefault(key, chain)
+    if registered != chain:
+        raise ValueError(f"Chain key collision: {universal_id_for_key(key)} stands for "
+                         f"{registered} and {chain}")
+
+def intron_chains(chains, class_df):
+    """
+    Intron chains of transcripts from their junction chains: chromosome,
+    strand (from the classification; "." if unknown) and the internal
+    junction coordinates, without the transcript start and end. Mono-exonic
+    transcripts keep their exon coordinates, after a MONOEXON mark.
+    Returns dict: transcript_id -> tuple.
+    """
+    strands = dict(zip(class_df["isoform"], class_df["strand"].astype(object).fillna(".")))
+    return {
+        tid: (chain[0], strands.get(tid, ".")) + (tuple(chain[2:-1]) if len(chain) > 3 else (MONOEXON,) + tuple(chain[1:]))
+        for tid, chain in chains.items()
+    }
+
+def split_chain(chain):
+    """
+    (chromosome, labels, coordinates) of a junction chain; labels are the
+    strand and MONOEXON mark of intron chains, empty for exon chains.
+    """
+    n = 1
+    while n < len(chain) and isinstance(chain[n], str):
+        n += 1
+    return chain[0], tuple(chain[1:n]), list(chain[n:])
+
+def sample_chains(tables, chain_mode="exon"):
+    """
+    transcript_id -> chain of one sample: its junction chain (the cached
+    chains, or extracted from the GTF), or intron chain in "intron" mode.
+    """
+    chains = tables.get("chains")  # precomputed when parsing with a cache
+    if chains is None:
+        chains = extract_junction_chain_from_gtf(tables["gtf"])
+    if chain_mode == "intron":
+        chains = intron_chains(chains, tables["classification"])
+    return chains
+
+def count_chains(chains):
+    """Number of transcripts of every chain, over dicts of transcript_id -> chain."""
+    return Counter(tuple(chain) for c in chains for chain in c.values())
+
+def write_standardized_tables(pickle_df, out_dir):
+    """Save the standardized junctions and classification of every sample as TSV."""
+    for sample in pickle_df["samples"]:
+        pickle_df["data"][sample]["junctions"].to_csv(f"{out_dir}/{sample}_junctions_std.tsv", sep="\t", index=False)
+        pickle_df["data"][sample]["classification"].to_csv(f"{out_dir}/{sample}_classification_std.tsv", sep="\t", index=False)
+
+def standardize_isoforms_cross_sample(pickle_df, out_dir=None, verbose=True, chain_mode="exon", tolerance=0,
+                                      representatives=None, registry=None):
     """
     Standardize isoform IDs across all samples using junction chains from GTF files.
+    The standardized tables are saved as TSV to out_dir if given.
+    Chains are exon or intron chains (chain_mode); with a tolerance, chains
+    within `tolerance` bp of each other share the ID and junction chain of
+    their representative (see ujc_fuzzy.py), computed here over these
+    samples unless given as `representatives` (chain -> representative).
+    The key of every chain is checked against those of the other chains in
+    `registry` (chain key -> chain, e.g. shared by the batches of a run).
     """
     samples = pickle_df["samples"]
     # extract junction chains per sample
-    sample_chains = {}
+    chains_by_sample = {}
     for sample in samples:
-        sample_chains[sample] = extract_junction_chain_from_gtf(pickle_df["data"][sample]["gtf"])
-        print(f"Extracted {len(sample_chains[sample])} junction chains for sample {sample}")
+        chains_by_sample[sample] = sample_chains(pickle_df["data"][sample], chain_mode)
+        if verbose:
+            print(f"Extracted {len(chains_by_sample[sample])} junction chains for sample {sample}")
+    if tolerance and representatives is None:
+        representatives = merge_near_chains(count_chains(chains_by_sample.values()), tolerance)
+    representatives = representatives or {}
     # collect all junction chains into a set of unique chains
     all_chains_set = set()
-    for chains in sample_chains.values():
+    for chains in chains_by_sample.values():
         for chain in chains.values():
             all_chains_set.add(tuple(chain))  # convert list -> tuple for hashability
 
-    # assign universal IDs
-    unique_chains = list(all_chains_set)
-    ids = {tuple(chain): f"isoform{i+1}" for i, chain in enumerate(unique_chains)}
+    # assign universal IDs (a function of the chain only, so stable across runs
+    # unless chains are merged with a tolerance), once per chain
+    registry = {} if registry is None else registry
+    keys = {}
+    for chain in set(representatives.get(chain, chain) for chain in all_chains_set):
+        keys[chain] = chain_key(chain)
+        register_chain_key(registry, keys[chain], chain)
+    ids = {chain: universal_id_for_key(keys[representatives.get(chain, chain)]) for chain in all_chains_set}
+    # junction chains of the tables: the chain itself (with the labels of intron
+    # chains, which are part of the ID), or its representative if merged
+    stored = None
+    if representatives:
+        stored = {chain: list(representatives.get(chain, chain)) for chain in all_chains_set}
 
     # create sample-specific mapping and add to DataFrames
     for sample in samples:
-        chains = sample_chains[sample]
+        chains = chains_by_sample[sample]
         iso_map = {tid: ids[tuple(chain)] for tid, chain in chains.items()}
+        if stored is not None:
+            chains = {tid: stored[tuple(chain)] for tid, chain in chains.items()}
 
         # Update junctions
         junc_df = pickle_df["data"][sample]["junctions"].copy()
@@ -87,38 +279,37 @@ def standardize_isoforms_cross_sample(pickle_df, out_dir=None):
             expr_df.insert(0, "universal_id", expr_df.iloc[:, 0].map(iso_map))
             pickle_df["data"][sample]["expression"] = expr_df
 
-        # save TSVs
-        junc_df.to_csv(f"{out_dir}/{sample}_junctions_std.tsv", sep="\t", index=False)
-        class_df.to_csv(f"{out_dir}/{sample}_classification_std.tsv", sep="\t", index=False)
-        #if expr_df is not None:
-        #    expr_df.to_csv(out_dir / f"{sample}_expression_std.tsv", sep="\t", index=False)
-
+    if out_dir is not None:
+        write_standardized_tables(pickle_df, out_dir)
     return pickle_df
 
 def main():
     parser = argparse.ArgumentParser(description="Standardize isoform IDs across all samples using GTF")
-    parser.add_argument("--pickle", required=True,
-                        help="Pickle file with parsed SQANTI3 outputs")
+    parser.add_argument("--store", required=True,
+                        help="Intermediate store with parsed SQANTI3 outputs")
     parser.add_argument("--out", required=True,
-                        help="Output folder for updated TSVs and pickle")
+                        help="Output folder for updated TSVs and intermediate store")
+    parser.add_argument("--chain_mode", default="exon", choices=CHAIN_MODES,
+                        help="Key UJCs by every exon coordinate (exon) or by internal junctions and strand (intron)")
+    parser.add_argument("--junction_tolerance", type=int, default=0,
+                        help="Merge chains whose coordinates all differ by at most this many bp (default: 0)")
 
     args = parser.parse_args()
 
     out_dir = Path(args.out)
 
     # Load parsed data
-    with open(args.pickle, "rb") as f:
-        pickle_df = pickle.load(f)
-        # Standardize isoforms
-        updated_obj = standardize_isoforms_cross_sample(pickle_df, args.out)
+    pickle_df = read_store(args.store)
+    # Standardize isoforms
+    updated_obj = standardize_isoforms_cross_sample(pickle_df, args.out, chain_mode=args.chain_mode,
+                                                    tolerance=args.junction_tolerance)
 
-    # Save updated pickle
-    out_pickle = f"{out_dir}/sqanti3_standardized.pkl"
-    with open(out_pickle, "wb") as f:
-        pickle.dump(updated_obj, f)
+    # Save updated tables; the GTF is read from the input store
+    out_store = out_dir / "sqanti3_standardized"
+    write_store(updated_obj, out_store, tables=["classification", "junctions", "expression"], base=args.store)
 
     print(f"Standardized isoform IDs for {len(pickle_df['samples'])} samples")
-    print(f"Updated pickle saved to {out_pickle}")
+    print(f"Updated tables saved to {out_store}")
     #print(f"TSVs saved in {out_dir}")
 
 if __name__ == "__main__":
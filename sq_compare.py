@@ -2,63 +2,378 @@
 
 import os
 import argparse
-import subprocess
+import shutil
 import sys
 
-def run_script(script, args):
-    """Helper function to run a Python script via subprocess."""
-    cmd = [sys.executable, script] + args
-    print("Running:", " ".join(cmd))
-    result = subprocess.run(cmd, check=True)
-    return result
+# Pipeline stages live in scripts/; import them so every stage runs in this
+# process and hands the parsed SQANTI3 object over in memory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+from parse_sq_inputs import parse_sqanti3_inputs, read_input_rows, load_samples, get_sample_name
+from collapse_ism import collapse_samples
+from universal_id import standardize_isoforms_cross_sample, CHAIN_MODES
+from tmm_norm import normalize_samples, read_norm_factors, sample_counts
+from generalize_isoforms import build_catalog, write_catalog_tables
+from sample_cache import DEFAULT_CACHE_SIZE_GB, evict
+from intermediate_store import write_store, read_store, read_table, store_samples
+from ujc_catalog import load_catalog, save_catalog, merge_catalogs, check_params, catalog_path, catalog_expression, catalog_counts
+from ujc_index import main as query_main
+from chrom_partition import standardize_by_chrom, build_catalog_by_chrom
+from out_of_core import DEFAULT_MEMORY_LIMIT_GB, parse_to_store, map_store, catalog_from_store, near_chain_representatives
+from run_metrics import STAGES, new_run, total_rows, add_sample_rows, add_rows, write_metrics
+from pipeline_dag import plan_run, run_pipeline, files_fingerprint
 
 def main():
+    # sq_compare.py query ...: look up UJCs in the index of a finished run
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        query_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="Run the isoform analysis pipeline without Nextflow.")
-    
+
     parser.add_argument("--input_files", required=True,
                         help="TSV file with paths to SQANTI3 outputs (classification, junctions, GTF, optional expression).")
     parser.add_argument("--out", required=True,
                         help="Output folder for results.")
     parser.add_argument("--collapseISM", action="store_true",
                         help="Whether to collapse ISM isoforms.")
-    
+    parser.add_argument("--keep_intermediates", action="store_true",
+                        help="Write each stage's tables to a Parquet store (sqanti3_samples/, sqanti3_standardized/, ...) in the output folder.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes for per-sample stages.")
+    parser.add_argument("--full_tables", action="store_true",
+                        help="Keep all classification/junctions columns (default: only those used by the pipeline).")
+    parser.add_argument("--cache_dir", default=None,
+                        help="Directory for cached per-sample parse and junction chain results, reused while inputs are unchanged.")
+    parser.add_argument("--cache_size", type=float, default=DEFAULT_CACHE_SIZE_GB,
+                        help=f"Cache size limit in GB; least recently used entries are evicted (default: {DEFAULT_CACHE_SIZE_GB}).")
+    parser.add_argument("--append", action="store_true",
+                        help="Add the samples of --input_files that are not yet in the UJC catalog of --out, without reprocessing the others.")
+    parser.add_argument("--partition_by_chrom", action="store_true",
+                        help="Assign universal IDs and build the isoform matrix per chromosome, on --workers processes.")
+    parser.add_argument("--chain_mode", default="exon", choices=CHAIN_MODES,
+                        help="Key UJCs by every exon start and end (exon, default) or by internal junctions and strand only (intron).")
+    parser.add_argument("--junction_tolerance", type=int, default=0,
+                        help="Merge UJCs whose chain coordinates all differ by at most this many bp (default: 0, exact matching).")
+    parser.add_argument("--out_of_core", action="store_true",
+                        help="Process samples in batches that fit in --memory_limit, spilling every stage's tables to a Parquet store in the output folder.")
+    parser.add_argument("--memory_limit", type=float, default=DEFAULT_MEMORY_LIMIT_GB,
+                        help=f"Approximate memory ceiling in GB of a batch with --out_of_core (default: {DEFAULT_MEMORY_LIMIT_GB}).")
+    parser.add_argument("--plot_format", "--plot-format", default="jpeg", choices=["jpeg", "png", "pdf", "svg"],
+                        help="Image format of the summary figures (default: jpeg).")
+    parser.add_argument("--dpi", type=int, default=300,
+                        help="Resolution of raster summary figures (default: 300).")
+    parser.add_argument("--top_intersections", type=int, default=64,
+                        help="Number of largest sample intersections in intersections.tsv and the UpSet plot; 0 for all (default: 64).")
+    parser.add_argument("--heatmap_top", type=int, default=1000,
+                        help="Number of most variable UJCs in the expression clustermap (default: 1000).")
+    parser.add_argument("--heatmap_cluster_rows", type=int, default=0,
+                        help="Cluster a random subsample of this many clustermap rows and place the others next to their nearest clustered row (default: 0, cluster all rows).")
+    parser.add_argument("--profile", nargs="+", choices=STAGES, metavar="STAGE",
+                        help=f"Write cProfile dumps of these stages to <out>/profiles/<stage>.prof ({', '.join(STAGES)}).")
+    parser.add_argument("--skip_plots", "--skip-plots", action="store_true",
+                        help="Only write the summarized tables; render the summary later with scripts/sq_compare_summary.py --out.")
+    parser.add_argument("--from_stage", "--from-stage", choices=STAGES, default=None,
+                        help="First stage to run; the outputs of the stages before it are read from their stores (see --until_stage).")
+    parser.add_argument("--until_stage", "--until-stage", choices=STAGES, default=None,
+                        help="Last stage to run; its output is saved to its store for a later --from_stage run.")
+
     args = parser.parse_args()
-    
+    if args.junction_tolerance < 0:
+        parser.error("--junction_tolerance must be 0 or more")
+    if args.top_intersections < 0:
+        parser.error("--top_intersections must be 0 or more")
+    if args.heatmap_top < 1:
+        parser.error("--heatmap_top must be 1 or more")
+    if args.heatmap_cluster_rows < 0:
+        parser.error("--heatmap_cluster_rows must be 0 or more")
+    if args.junction_tolerance and args.append:
+        # merged chains take the ID of a representative chosen among the samples of a run
+        parser.error("--junction_tolerance cannot be combined with --append")
+
     #Make output folders
     os.makedirs(args.out, exist_ok=True)
-    
+
+    with open(args.input_files) as f:
+        first_line = f.readline()
+        num_cols = len(first_line.strip().split('\t'))
+    params = {"collapseISM": args.collapseISM, "expression": num_cols == 4,
+              "chain_mode": args.chain_mode, "junction_tolerance": args.junction_tolerance}
+
+    # Incremental mode: only samples missing from the existing catalog are processed
+    catalog = load_catalog(args.out) if args.append else None
+    exclude = None
+    if catalog:
+        check_params(catalog, params)
+        exclude = set(catalog["samples"])
+
+    stages = pipeline_stages(args, params, catalog, exclude)
+    try:
+        plan = plan_run(stages, args.out, args.from_stage, args.until_stage)
+    except ValueError as e:
+        parser.error(str(e))
+
+    profile_dir = os.path.join(args.out, "profiles")
+    metrics = new_run(sys.argv)
+    try:
+        run_pipeline(stages, args.out, metrics, plan, keep=args.keep_intermediates,
+                     profiled=lambda name: profile_dir if name in (args.profile or []) else None)
+    finally:
+        write_metrics(metrics, args.out)
+    if args.skip_plots and args.until_stage in (None, "matrix"):
+        print(f"Skipping summary plots; render them with: python scripts/sq_compare_summary.py --out {args.out}")
+
+# Intermediate store of each data stage, in the output folder
+STORES = {
+    "parse": "sqanti3_samples",
+    "collapse": "sqanti3_samples_ISMcollapsed",
+    "universal_id": "sqanti3_standardized"
+}
+
+def write_catalog(catalog, new_catalog, params, out, factors=None):
+    """
+    Merge the new samples into the UJC catalog and write the catalog, and
+    the isoform tables and UJC index normalized with the TMM factors of the cohort.
+    """
+    new_catalog["params"] = params
+    catalog = merge_catalogs(catalog, new_catalog) if catalog else new_catalog
+    save_catalog(catalog, out)
+    return write_catalog_tables(catalog, out, factors)
+
+def pipeline_stages(args, params, catalog, exclude):
+    """
+    The stages of a run (see pipeline_dag.py), in order. Stages hand the
+    SQANTI3 object over in memory, or with --out_of_core the path of their
+    intermediate store.
+    """
+    store = lambda name: os.path.join(args.out, STORES[name])
+    chains = {"chain_mode": args.chain_mode, "tolerance": args.junction_tolerance}
+    budget = args.memory_limit * 1e9
+    stages = []
+    upstream = lambda inputs: next(iter(inputs.values()))   # output of the stage before
+
+    def add(name, title, run, run_out_of_core, params=None, outputs=(), save_tables=None, deps=None):
+        if deps is None:
+            deps = [stages[-1]["name"]] if stages else []
+        spec = {"name": name, "title": title, "deps": deps, "params": params, "outputs": list(outputs),
+                "store": store(name) if name in STORES else None}
+        if args.out_of_core:
+            spec.update(run=run_out_of_core, load=lambda: spec["store"])
+        else:
+            spec["run"] = run
+            if name in STORES:
+                spec["load"] = lambda: read_store(spec["store"])
+                spec["save"] = lambda data, stored: save_data(data, spec, stored, save_tables)
+        stages.append(spec)
+
+    def save_data(data, spec, stored, tables):
+        # tables the stage did not change are read from the previous store, if saved
+        base = spec["deps"][0] if spec["deps"] and spec["deps"][0] in stored else None
+        if tables is None or base is None:
+            write_store(data, spec["store"])
+        else:
+            write_store(data, spec["store"], tables=tables, base=store(base))
+
     #1: Parse inputs
-    run_script("scripts/parse_sq_inputs.py", ["--input_files", args.input_files, "--out", args.out])
-    
+    def parse(inputs, record):
+        sample_metrics = {}
+        data = parse_sqanti3_inputs(args.input_files, workers=args.workers, full_tables=args.full_tables, exclude=exclude,
+                                    cache_dir=args.cache_dir, cache_size_gb=args.cache_size, sample_metrics=sample_metrics)
+        record["samples"] = sample_metrics
+        record["rows_out"] = total_rows(data)
+        add_sample_rows(record, data)
+        return data if parsed(data["samples"]) else None
+
+    def parse_out_of_core(inputs, record):
+        record["samples"] = {}
+        def load(rows):
+            tables = load_samples(rows, workers=args.workers, full_tables=args.full_tables,
+                                  cache_dir=args.cache_dir, sample_metrics=record["samples"])
+            return {"n_samples": len(tables), "samples": list(tables), "data": tables}
+        def loaded(data, first):
+            add_rows(record, "rows_out", data)
+            add_sample_rows(record, data)
+        samples = parse_to_store(read_input_rows(args.input_files, exclude), store("parse"), budget, load, loaded)
+        if args.cache_dir is not None:
+            evict(args.cache_dir, args.cache_size * 1e9)
+        return store("parse") if parsed(samples) else None
+
+    def parsed(samples):
+        if not samples:
+            print(f"No new samples to add to the UJC catalog in {args.out}")
+            return False
+        print(f"Parsed {len(samples)} samples: {', '.join(samples)}")
+        return True
+
+    # the inputs are fingerprinted by path, size and modification time
+    rows = read_input_rows(args.input_files)
+    input_paths = [args.input_files] + [p for row in rows for p in row]
+    # samples the stages process: with --append, the new ones (and the whole
+    # cohort of the catalog for the factors and the matrix)
+    excluded = sorted(exclude or [])
+    new_samples = [name for name in map(get_sample_name, (row[0] for row in rows)) if name not in (exclude or ())]
+    cohort = (catalog["samples"] if catalog else []) + new_samples
+    add("parse", "parse SQANTI3 inputs", parse, parse_out_of_core,
+        params={"inputs": files_fingerprint(input_paths), "full_tables": args.full_tables,
+                "append": args.append, "exclude": excluded})
+
     #2: Collapse ISM (optional)
+    def collapse(inputs, record):
+        data = inputs["parse"]
+        record["rows_in"] = total_rows(data)
+        sample_metrics = {}
+        data = collapse_samples(data, args.out, append=args.append, workers=args.workers,
+                                sample_metrics=sample_metrics)
+        record["samples"] = sample_metrics
+        record["rows_out"] = total_rows(data)
+        add_sample_rows(record, data)
+        return data
+
+    def collapse_out_of_core(inputs, record):
+        record["samples"] = {}
+        def collapse_batch(data, first):
+            add_rows(record, "rows_in", data)
+            # the first batch starts the collapsed summary, unless appending to a previous run
+            data = collapse_samples(data, args.out, append=args.append or not first, workers=args.workers,
+                                    sample_metrics=record["samples"])
+            add_rows(record, "rows_out", data)
+            add_sample_rows(record, data)
+            return data
+        map_store(collapse_batch, inputs["parse"], store("collapse"), store_samples(inputs["parse"]), budget)
+        return store("collapse")
+
     if args.collapseISM:
-        run_script("scripts/collapse_ism.py", ["--pickle", f'{args.out}/sqanti3_samples.pkl', "--out", args.out])
-    
+        add("collapse", "collapse ISM", collapse, collapse_out_of_core, params={"samples": new_samples},
+            outputs=[os.path.join(args.out, "ISMcollapsed_summary.tsv")])
+
     #3: Assign universal IDs
-    if args.collapseISM:
-        pickle_df = f'{args.out}/sqanti3_samples_ISMcollapsed.pkl' # use collapsed pickle if ISM collapsing was done
-    else:
-        pickle_df = f'{args.out}/sqanti3_samples.pkl'
- 
-    run_script("scripts/universal_id.py", ["--pickle", pickle_df, "--out", args.out])
+    def standardize(data, record, options):
+        record["rows_in"] = record.get("rows_in", 0) + total_rows(data)
+        if args.partition_by_chrom:
+            data = standardize_by_chrom(data, args.out, workers=args.workers, **options)
+        else:
+            data = standardize_isoforms_cross_sample(data, args.out, **options)
+        add_rows(record, "rows_out", data)
+        add_sample_rows(record, data)
+        return data
+
+    def universal_id(inputs, record):
+        data = standardize(upstream(inputs), record, chains)
+        print(f"Standardized isoform IDs for {len(data['samples'])} samples")
+        return data
+
+    def universal_id_out_of_core(inputs, record):
+        previous = upstream(inputs)
+        samples = store_samples(previous)
+        # chain keys are checked across the batches
+        options = dict(chains, registry={})
+        if args.junction_tolerance:
+            # chains are merged over the whole cohort, before the batches get their IDs
+            options["representatives"] = near_chain_representatives(previous, samples, budget, args.chain_mode,
+                                                                    args.junction_tolerance)
+        # the GTF and chains are unchanged: read them from the previous store
+        map_store(lambda data, first: standardize(data, record, options), previous, store("universal_id"), samples,
+                  budget, tables=["classification", "junctions", "expression"], base=previous)
+        print(f"Standardized isoform IDs for {len(samples)} samples")
+        return store("universal_id")
+
+    add("universal_id", "assign universal IDs", universal_id, universal_id_out_of_core,
+        params=dict(chains, samples=new_samples),
+        save_tables=["classification", "junctions", "expression"])
+
+    #4 TMM normalization of expression values if provided: the factors are
+    # computed over the whole cohort, including the samples of the catalog
+    # with --append, and applied when the tables are written
+    def normalize_cohort(samples, expression, record):
+        # samples of the catalog: counts by chain key straight from its raw expression rows
+        old = [s for s in catalog["samples"] if s in catalog["expression"]] if catalog else []
+        new, rows_in = [], 0
+        for sample in samples:
+            expr_df = expression(sample)
+            if expr_df is not None:
+                new.append(sample)
+                rows_in += len(expr_df)
+        record["rows_in"] = record["rows_out"] = rows_in
+        in_catalog = set(old)
+        def cohort_expression(sample):
+            if sample in in_catalog:
+                return catalog_expression(catalog, sample)
+            return expression(sample)
+        def counts(sample):
+            if sample in in_catalog:
+                return catalog_counts(catalog, sample)
+            return sample_counts(expression(sample))
+        return normalize_samples(old + new, cohort_expression, args.out, counts)
+
+    def tmm(inputs, record):
+        data = inputs["universal_id"]
+        return normalize_cohort(data["samples"], lambda s: data["data"][s]["expression"], record)
+
+    def tmm_out_of_core(inputs, record):
+        previous = inputs["universal_id"]
+        expression = lambda s: read_table(previous, "expression", s, columns=["universal_id", "count"])
+        return normalize_cohort(store_samples(previous), expression, record)
+
+    if params["expression"]:
+        add("tmm", "TMM normalization", tmm, tmm_out_of_core, params={"samples": cohort},
+            outputs=[os.path.join(args.out, "normalized_expression", "norm_factors.tsv")])
+        stages[-1]["load"] = lambda: read_norm_factors(args.out)
+
+    #5 create matrix and isoform info
+    def matrix_stage(inputs, record):
+        data = inputs["universal_id"]
+        record["rows_in"] = total_rows(data)
+        if args.partition_by_chrom:
+            new_catalog = build_catalog_by_chrom(data, workers=args.workers)
+        else:
+            new_catalog = build_catalog(data)
+        isoform_info, matrix = write_catalog(catalog, new_catalog, params, args.out, inputs.get("tmm"))
+        record["rows_out"] = len(isoform_info)
+        return isoform_info, matrix
+
+    def matrix_out_of_core(inputs, record):
+        previous = inputs["universal_id"]
+        def build(data):
+            add_rows(record, "rows_in", data)
+            if args.partition_by_chrom:
+                return build_catalog_by_chrom(data, workers=args.workers)
+            return build_catalog(data)
+        new_catalog = catalog_from_store(previous, store_samples(previous), budget, build, params)
+        isoform_info, matrix = write_catalog(catalog, new_catalog, params, args.out, inputs.get("tmm"))
+        record["rows_out"] = len(isoform_info)
+        if not args.keep_intermediates:
+            for name in STORES:
+                if os.path.isdir(store(name)):
+                    shutil.rmtree(store(name))
+        return isoform_info, matrix
+
+    summarized = os.path.join(args.out, "summarized")
+    # the matrix holds raw counts: it reads the standardized tables, and the factors
+    add("matrix", "isoform matrix", matrix_stage, matrix_out_of_core, params=dict(params, samples=cohort),
+        deps=["universal_id", "tmm"] if params["expression"] else ["universal_id"],
+        outputs=[catalog_path(args.out), os.path.join(summarized, "isoform_info.tsv"),
+                 os.path.join(summarized, "isoform_matrix.tsv")])
+    # isoform_info and the matrix are read back from the TSVs by summarize
+    stages[-1]["load"] = lambda: (None, None)
+
+    #6: Visualize comparisons
+    def summary(inputs, record):
+        # imported here: plotting libraries are only loaded once the tables exist
+        from sq_compare_summary import summarize
+        isoform_info, matrix = inputs["matrix"]
+        if isoform_info is not None:
+            record["rows_in"] = len(isoform_info)
+        summarize(args.out, isoform_info, matrix, plot_format=args.plot_format, dpi=args.dpi, workers=args.workers,
+                  top_intersections=args.top_intersections, heatmap_top=args.heatmap_top,
+                  heatmap_cluster_rows=args.heatmap_cluster_rows)
+        return True
+
+    if not args.skip_plots:
+        plots = {"plot_format": args.plot_format, "dpi": args.dpi, "top_intersections": args.top_intersections,
+                 "heatmap_top": args.heatmap_top, "heatmap_cluster_rows": args.heatmap_cluster_rows}
+        add("summary", "summary", summary, summary, params=plots,
+            outputs=[os.path.join(summarized, "sq_compare_stats.pdf")])
+    return stages
 
-    #4 TMM normalization of expression values if provided
-    with open(args.input_files) as f:
-        first_line = f.readline()
-        num_cols = len(first_line.strip().split('\t'))
-    if num_cols == 4:
-        run_script("scripts/tmm_norm.py", ["--pickle", f"{args.out}/sqanti3_standardized.pkl", "--out", args.out])
-        #5 create matrix and isoform info
-        run_script("scripts/generalize_isoforms.py", ["--pickle", f"{args.out}/sqanti3_normalized.pkl", "--out", args.out])
-    else:
-        run_script("scripts/generalize_isoforms.py", ["--pickle", f"{args.out}/sqanti3_standardized.pkl", "--out", args.out])
-
-    #5: Visualize comparisons
-    run_script("scripts/sq_compare_summary.py", ["--out", args.out])
-
-    # Delete all pickle files in the output directory
-    for file in os.listdir(args.out):
-        if file.endswith(".pkl"):
-            os.remove(os.path.join(args.out, file))
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()